@@ -13,6 +13,11 @@ import math
 from scipy import signal
 
 
+class dem_topology:  # DEM tree topology
+    segmented = 1  # segmenting switching block per bit level, non-segmenting tree over the channels
+    nonsegmenting = 2  # non-segmenting tree over the channels only (splits the whole code)
+
+
 def ssb(c, d):
     """
     Segmenting switching block.
@@ -65,13 +70,19 @@ def nssb(c, d):
     return int(t), int(b)  # top switch, bottom switch
 
 
-def dem(X, Rng, Nb):
+def dem(X, Rng, Nb, Nch=2, TOPOLOGY=dem_topology.segmented):
     """
     X
         input signal
     Rng, N
         quantiser params. (for re-quantisation and code generation)
+    Nch
+        number of output DACs (2, 4, 8, ...)
+    TOPOLOGY
+        DEM tree topology (see dem_topology); the two-DAC segmented tree is the original DEM
     """
+    if Nch != 2 or TOPOLOGY != dem_topology.segmented:
+        return dem_tree.get(Nb, Nch, TOPOLOGY).encode(X, Rng)
     
     # DEM code input range
     M = 2*(2**Nb - 1)
@@ -90,43 +101,212 @@ def dem(X, Rng, Nb):
     Ci = np.zeros(X.size).astype(int)  # initial codes
     #Csum = np.zeros(X.size).astype(int)  # sum of segmented codes (verification)
 
-    # from lin_method_dem import ssb, nssb # 
-
-    for i in range(0, X.size):
-        w = X[i]
+    match 2:
+        case 1:  # per-sample loop
+            for i in range(0, X.size):
+                w = X[i]
         
-        # Re-quantizer for segmented DAC
-        qs = math.floor(w/Qseg + 0.5) + cin # mid-tread
+                # Re-quantizer for segmented DAC
+                qs = math.floor(w/Qseg + 0.5) + cin # mid-tread
         
-        # Generate DEM codes
-        c = qs + cmin
-        Ci[i] = c
+                # Generate DEM codes
+                c = qs + cmin
+                Ci[i] = c
                     
-        # DEM 
-        Ss = np.zeros((2, Nb)).astype(int) # segment switching block results
-        c1 = c # initial switching block input
+                # DEM 
+                Ss = np.zeros((2, Nb)).astype(int) # segment switching block results
+                c1 = c # initial switching block input
         
-        # random switching sequence
-        d = np.random.randint(2, size=2*Nb-1) # white
+                # random switching sequence
+                d = np.random.randint(2, size=2*Nb-1) # white
         
-        for j in range(0, Nb-1):
-            Sst, Ssb = ssb(c1, d[2*j]) # segmenting switching
+                for j in range(0, Nb-1):
+                    Sst, Ssb = ssb(c1, d[2*j]) # segmenting switching
             
-            c1 = Sst  # save for next iteration
-            c2 = Ssb  # feed to next switching block
+                    c1 = Sst  # save for next iteration
+                    c2 = Ssb  # feed to next switching block
             
-            Snt, Snb = nssb(c2, d[2*j+1])  # non-segmenting switching
+                    Snt, Snb = nssb(c2, d[2*j+1])  # non-segmenting switching
 
-            Ss[0, j] = Snt
-            Ss[1, j] = Snb
+                    Ss[0, j] = Snt
+                    Ss[1, j] = Snb
         
-        c2 = Sst
-        Snt, Snb = nssb(c2, d[-1]) # non-segmenting switching
+                c2 = Sst
+                Snt, Snb = nssb(c2, d[-1]) # non-segmenting switching
 
-        Ss[0, Nb-1] = Snt
-        Ss[1, Nb-1] = Snb
+                Ss[0, Nb-1] = Snt
+                Ss[1, Nb-1] = Snb
         
-        C[:, i] = np.sum(Ss*Ks, 1)
-        #Csum[i] = np.sum(C[:, i]) # (verification)
+                C[:, i] = np.sum(Ss*Ks, 1)
+                #Csum[i] = np.sum(C[:, i]) # (verification)
+        case 2:  # vectorised over samples, in blocks
+            C, Ci = dem_vectorised(X, Qseg, cin, cmin, Nb)
+
+    return C
+
+
+def dem_vectorised(X, Qseg, cin, cmin, Nb, BLOCK=2**13):
+    """
+    DEM encoder evaluating each level of the switching tree for a block of samples at a
+    time with array arithmetic. The switching bits are drawn per block, in the same order
+    as the per-sample loop in dem, so the output is identical for a fixed seed.
+
+    Arguments
+        X - input signal
+        Qseg, cin, cmin - segmented step-size and code offsets (see dem)
+        Nb - number of bits
+        BLOCK - number of samples per block (bounds the memory for the switching bits)
+
+    Returns
+        C - individual DAC codes (1 ch. per row)
+        Ci - initial codes
+    """
+    X = X.reshape(-1)
+
+    # Re-quantizer for segmented DAC (mid-tread), and DEM codes
+    Ci = np.floor(X/Qseg + 0.5).astype(int) + cin + cmin
+
+    C = np.zeros((2, X.size)).astype(int)
+
+    # Switching blocks in closed form (o = c mod 2, d = switching bit):
+    #   ssb(c, d) = (c//2 - (1-o)*d, 1 + (1-o)*(2*d-1)), i.e. the bottom output is 1 or 2*d
+    #   nssb(c, d) = (c//2 + o*(1-d), c//2 + o*d)
+    # The two DAC codes sum to the initial code, so only the bottom one is accumulated.
+    for k in range(0, X.size, BLOCK):
+        c1 = Ci[k:k+BLOCK].astype(np.int32)  # initial switching block input
+        Cb = np.zeros(c1.size, dtype=np.int32)
+
+        # random switching sequence
+        d = np.random.randint(2, size=(c1.size, 2*Nb-1)).T.astype(np.int32) # white (one row per switching block)
+
+        for j in range(0, Nb-1):
+            es = d[2*j] & ~c1  # segmenting switching, (1-o)*d
+            Cb += ((d[2*j+1] & c1) | es) << j  # non-segmenting switching of the bottom output
+            c1 = (c1 >> 1) - es  # top output, for the next iteration
+
+        # non-segmenting switching
+        Cb += ((c1 >> 1) + (d[-1] & c1)) << (Nb-1)
+
+        C[1, k:k+BLOCK] = Cb
+        C[0, k:k+BLOCK] = Ci[k:k+BLOCK] - Cb
+
+    return C, Ci
+
+
+class dem_tree:
+    """
+    DEM encoder for Nch binary-weighted Nb-bit DACs with a given tree topology. The tables
+    are built once per (Nb, Nch, TOPOLOGY) and shared, see get.
+
+    dem_topology.segmented: at each bit level a segmenting switching block chooses how many
+    of the Nch elements of that weight are on (Nch/2, or Nch/2 ± 1 at random to match the
+    parity of its input), and a non-segmenting tree distributes them over the channels. With
+    Nch = 2 this is the tree of dem, with the same switching bits and codes.
+
+    dem_topology.nonsegmenting: a non-segmenting tree splits the code over the channels.
+
+    :param Nb: Number of bits of each DAC
+    :param Nch: Number of DACs, a power of 2
+    :param TOPOLOGY: Tree topology (see dem_topology)
+    """
+    _trees = {}  # built encoders
+
+    @classmethod
+    def get(cls, Nb, Nch, TOPOLOGY=dem_topology.segmented):
+        key = (Nb, Nch, TOPOLOGY)
+        if key not in cls._trees:
+            cls._trees[key] = cls(Nb, Nch, TOPOLOGY)
+        return cls._trees[key]
+
+    def __init__(self, Nb, Nch, TOPOLOGY=dem_topology.segmented):
+        if Nch < 2 or Nch & (Nch - 1):
+            raise ValueError('The number of DEM channels must be a power of 2.')
+
+        self.Nb = Nb
+        self.Nch = Nch
+        self.TOPOLOGY = TOPOLOGY
+
+        match TOPOLOGY:
+            case dem_topology.segmented:
+                # Input codes for which no switching sequence leaves the range of any level,
+                # from the last level (0..Nch elements of weight 2**(Nb-1)) down
+                lo, hi = 0, Nch
+                for j in range(0, Nb-1):
+                    lo, hi = 2*lo + Nch//2, 2*hi + Nch//2
+                self.cmin, self.cmax = lo, hi
+
+                # Non-segmenting tree allocation of 0..Nch elements, for each switching pattern
+                P = 2**(Nch-1)
+                self.T = np.zeros((Nch+1, P, Nch), dtype=np.int32)
+                for v in range(0, Nch+1):
+                    for p in range(0, P):
+                        d = (p >> np.arange(0, Nch-1)) & 1
+                        self.T[v, p] = self.nssb_tree(np.array([v]), d.reshape(-1, 1))[:, 0]
+
+                self.Nd = Nb*Nch - 1  # switching bits per sample
+            case dem_topology.nonsegmenting:
+                self.cmin, self.cmax = 0, Nch*(2**Nb - 1)
+                self.Nd = Nch - 1
+            case _:
+                raise ValueError('Unknown DEM tree topology.')
+
+    def nssb_tree(self, c, d):
+        """
+        Non-segmenting switching blocks in a binary tree over the channels; node k (breadth
+        first) uses switching bits d[k]. The top output of a block goes to the first half of
+        its channels.
+        """
+        V = [c]
+        k = 0
+        while len(V) < self.Nch:
+            W = []
+            for v in V:
+                s = np.where(v & 1, 2*d[k] - 1, 0)  # nssb
+                W += [(v - s) >> 1, (v + s) >> 1]  # top, bottom
+                k = k + 1
+            V = W
+        return np.array(V)
+
+    def encode(self, X, Rng, BLOCK=2**13):
+        """
+        Codes for input X (full scale Rng), one DAC per row.
+        """
+        X = X.reshape(-1)
+        Nb, Nch = self.Nb, self.Nch
+
+        # Re-quantizer for segmented DAC (mid-tread), offset to the middle of the input range
+        Qseg = Rng/(self.cmax - self.cmin)  # segmented step-size (LSB)
+        cin = (self.cmax - self.cmin)//2
+        Ci = np.floor(X/Qseg + 0.5).astype(int) + cin + self.cmin
+        Ci = np.clip(Ci, self.cmin, self.cmax)
+
+        C = np.zeros((Nch, X.size)).astype(int)
+        W = 2**np.arange(0, Nch-1)  # switching bits to table pattern
+
+        for k in range(0, X.size, BLOCK):
+            c1 = Ci[k:k+BLOCK]
+
+            # random switching sequence
+            d = np.random.randint(2, size=(c1.size, self.Nd)).T # white (one row per switching block)
+
+            match self.TOPOLOGY:
+                case dem_topology.segmented:
+                    Cb = np.zeros((c1.size, Nch), dtype=np.int32)
+                    for j in range(0, Nb):
+                        dj = d[j*Nch:(j+1)*Nch]
+                        if j < Nb-1:
+                            # segmenting switching
+                            s = np.where((c1 - Nch//2) & 1, 2*dj[0] - 1, 0)
+                            b = Nch//2 + s
+                            c1 = (c1 - b) >> 1  # top output, for the next level
+                            pat = W@dj[1:]
+                        else:
+                            b = c1
+                            pat = W@dj[0:Nch-1]
+                        Cb += self.T[b, pat] << j  # non-segmenting switching
+
+                    C[:, k:k+BLOCK] = Cb.T
+                case dem_topology.nonsegmenting:
+                    C[:, k:k+BLOCK] = self.nssb_tree(c1, d)
 
-    return C
\ No newline at end of file
+        return C
@@ -11,12 +11,19 @@
 import numpy as np
 from scipy import signal, linalg
 import math
+import sys
+import time
 from utils.balreal import balreal
+from utils.checkpoint import fingerprint
+from utils.ns_filters import nsf
+from LM.lin_method_nsdcal import nsdcal_stream
+from LM.lin_method_util import ilc_stats, inband_power
+from LM.lin_method_ilc_operators import ilc_learning_operators, ilc_periodic_operators, ilc_certificate, ilc_uniform_margin
 import tqdm
 
 class DSM_ILC:
 
-    def __init__(self, Nb, Qstep, Vmin, Vmax,  Qtype, Qmodel):
+    def __init__(self, Nb, Qstep, Vmin, Vmax,  Qtype, Qmodel, CHUNK=4096, FILTER=(2, nsf.integrator)):
         """
         Constructor for the Delta-sigma modulation with iterative learning control.
         :param Nb: Number of bits 
@@ -25,6 +32,8 @@ class DSM_ILC:
         :param QL: Quantization levels 
         :param b, a: Numerator and denominator;  Reconstruction filter
         :param imp_res: reconstruction filter impulse response
+        :param CHUNK: Number of samples per call of the noise-shaping loop
+        :param FILTER: Noise-shaping filter, (ORDER, DESIGN[, Wn]) for ns_filter
         """
         self.Nb = Nb
         self.Qstep = abs(Qstep)
@@ -32,6 +41,8 @@ class DSM_ILC:
         self.Vmax = Vmax
         self.Qtype = Qtype
         self.Qmodel = Qmodel
+        self.CHUNK = CHUNK
+        self.FILTER = FILTER
 
 
     # LEARNING MATRICES
@@ -81,36 +92,118 @@ class DSM_ILC:
         L = SubinverseL @ (G.transpose()@We)
 
         # Check if the stability and convergence condition are satisfied
-        ILCloop =  Q - np.matmul(L,G)
-        eig_ILC, vec_ILC = np.linalg.eig(ILCloop)       
-        eig_ILC_mon, vec_ILC_mon = np.linalg.eig(ILCloop @ ILCloop.transpose())
+        W = [np.diag(M)[0] for M in [We, Wf, Wdf]]
+        if all(np.array_equal(M, w*np.identity(len_X)) for M, w in zip([We, Wf, Wdf], W)):
+            # uniform weights, exact with the smallest singular value of G
+            margin = ilc_uniform_margin(*W, np.linalg.svd(G, compute_uv=False)[-1])
+            self.report_margins(margin, margin)
+        else:
+            self.certify(Q, L, G)
 
-        if max(eig_ILC) <=1:
-            print('Stablity Condition Satisfied')
-            if max(eig_ILC_mon) <=1:
-                print('ILC Monotonic Convergent Condition also Satisfied')
+        return Q, L, G
+
+
+    def learningOperators(self, len_X, We, Wf, Wdf, im, SOLVER='pcg'):
+        """ Structured alternative to learningMatrices for diagonal tuning weights.
+        Q, L and G are applied with FFT convolutions and CG solves (see lin_method_ilc_operators),
+        so the memory is O(len_X) and full simulation lengths are feasible.
+
+        inputs:
+        len_x   - length of reference signal
+        im      - filter's impulse response
+        we, wf, wdf - diagonal tuning weights, scalars or 1d arrays of length len_x
+        SOLVER  - 'pcg' (exact, to solver tolerance) or 'circulant' (approximation)
+
+        outputs:
+        q, l, g - operators, used as the matrices
+        """
+        Q, L, G = ilc_learning_operators(im[0], len_X, We, Wf, Wdf, SOLVER)
+
+        # Check if the stability and convergence condition are satisfied
+        self.certify(Q, L, G)
+
+        return Q, L, G
+
+
+    def certify(self, Q, L, G, METHOD='auto'):
+        """ Stability and monotonic convergence check of the ILC (see ilc_certificate).
+        outputs:
+        margin_s, margin_m - stability and monotonic convergence margins (satisfied if >= 0, NaN if unknown)
+        """
+        margin_s, margin_m = ilc_certificate(Q, L, G, METHOD)
+        self.report_margins(margin_s, margin_m)
+
+        return margin_s, margin_m
+
+
+    def report_margins(self, margin_s, margin_m):
+        if np.isnan(margin_s):
+            print('warning: Stability condition could not be checked')
+        elif margin_s >= 0:
+            print(f'Stablity Condition Satisfied (margin {margin_s:.3g})')
+            if np.isnan(margin_m):
+                print('warning: Monotonic convergence condition could not be checked')
+            elif margin_m >= 0:
+                print(f'ILC Monotonic Convergent Condition also Satisfied (margin {margin_m:.3g})')
         else:
             sys.exit('Stability condition not satisfied. Change tuning matrices')
 
-        return Q, L, G
-    
- 
-    def get_codes(self, Xcs, Dq, itr, YQns, MLns,  Q, L, G):
+
+    def periodicLearningOperators(self, len_X, We, Wf, Wdf, im, Fs=None):
+        """ Periodic (lifted, frequency-domain) ILC for an exactly periodic reference with
+        coherent sampling: G, Q and L are diagonal in the DFT over the signal, so each iteration
+        costs O(len_X log len_X) (see ilc_periodic_operators).
+
+        inputs:
+        len_x   - length of reference signal, whole periods
+        im      - filter's impulse response
+        we, wf, wdf - tuning weights, scalars or per frequency bin (len_x//2+1)
+        Fs      - sampling frequency, for reporting the worst bin (optional)
+
+        outputs:
+        q, l, g - operators, used as the matrices
+        rho     - convergence factor per frequency bin
+        """
+        Q, L, G, rho = ilc_periodic_operators(im[0], len_X, We, Wf, Wdf)
+
+        # Per-bin convergence factors, in place of the eigenvalue check
+        k = np.argmax(rho)
+        f = f' ({k*Fs/len_X:.4g} Hz)' if Fs is not None else ''
+        print(f'ILC convergence factor per bin: max {rho[k]:.6f} at bin {k}{f}, median {np.median(rho):.6f}')
+        if rho[k] < 1:
+            print('Stablity Condition Satisfied')
+        else:
+            sys.exit(f'Stability condition not satisfied in {np.sum(rho >= 1)} bins. Change tuning weights')
+
+        return Q, L, G, rho
+
+
+    def get_codes(self, Xcs, Dq, itr, YQns, MLns,  Q, L, G, CHECKPOINT=None, TOL=None, DIVERGE=None,
+                  BAND=None, ENOB_PROBE=None, PROBE_EVERY=0):
 
         """ INPUTS:
         Xcs     - Reference/Test signal 
         Dq      - Dither signal
-        itr     - Number of iterations
+        itr     - Number of iterations (maximum, with TOL or DIVERGE)
         YQns    - Ideal quantisation levels
         MLns    - Measured/ calibrated quantisation levels
         Q, L    - Q-filtering and Learning matrices
         G       - Output matrix; Reconstruction filter
         b1, a1  - Transfer functions; Reconstruction filter; numerator and denominator, respectively
+        CHECKPOINT - periodically save the progress, and resume an interrupted run (see utils.checkpoint)
+        TOL     - stop when the relative change of the RMS ILC error between iterations is below TOL
+        DIVERGE - stop when the RMS ILC error exceeds DIVERGE times the best so far; the codes
+                  of the best iteration are returned
+        BAND    - signal band for the in-band error power, normalised frequency (1 is Nyquist)
+        ENOB_PROBE  - function of the codes returning the ENOB through the static DAC model
+        PROBE_EVERY - probe the ENOB every PROBE_EVERY iterations (and at the last one)
         """
 
         """ OUTPUTS:
         Codes
         """
+        # Per-iteration record (see lin_method_util.ilc_stats_dtype)
+        self.stats = ilc_stats(itr)
 
         # Storage container: Codes
         ILC_C = []
@@ -127,61 +220,60 @@ class DSM_ILC:
         # Error 
         ilc_err = Xcs - y.squeeze()
 
+        # Codes and RMS error of the best iteration (for DIVERGE)
+        best_C = []
+        best_rms = np.inf
+
+        # Resume an interrupted run
+        i_start = 0
+        state = None
+        if CHECKPOINT is not None:
+            fp = fingerprint(Xcs, Dq, itr, YQns, MLns, Q, L, G, self.Nb, self.Qstep, self.Qmodel)
+            state = CHECKPOINT.load(fp)
+            if state is not None:
+                i_start = state['i']
+                init_u = state['init_u']
+                u_dsm_inp = state['u_dsm_inp']
+                ILC_C = state['ILC_C']
+                self.stats[0:i_start] = state['stats']
+                best_C, best_rms = state['best_C'], state['best_rms']
+                print(f'Resuming from iteration {i_start}, sample {state["j"]}')
+
         # ILC loop
-        for i in tqdm.tqdm(range(itr)):
+        n_itr = itr
+        for i in tqdm.tqdm(range(i_start, itr), initial=i_start, total=itr):
+            t_start = time.perf_counter()
+
             #NSD:
             ##########################
-            match 2:
-                case 1:
-                    bns = np.array([1, -2, 1])
-                    ans =  np.array([1, 0, 0])
-                    Mns_tf = signal.TransferFunction( ans-bns, ans, dt=1)  # Mns = 1 - Hns
-                    Mns = Mns_tf.to_ss()
-                    Ad, Bd, Cd, Dd = balreal(Mns.A, Mns.B, Mns.C, Mns.D)
-
-                case 2:
-                    AM = np.array([[0.0, 0.0], [1.0, 0.0]])
-                    BM = np.array([[2.0], [0.0]])
-                    CM = np.array([[1.0, -0.5]])
-                    DM = np.array([[0.0]])
-                    Ad, Bd, Cd, Dd = balreal(AM, BM, CM, DM)
-
-            # Initialise state, output and error
-            xns = np.zeros((Ad.shape[0], 1))  # noise-shaping filter state
-            yns = np.zeros((1, 1))  # noise-shaping filter output
-            e = np.zeros((1, 1))  # quantiser error
+            # Noise-shaping quantiser with carried state, run in chunks (the filter realisation
+            # is computed once, see ns_filter; code offset 2**(Nb-1) for the mid-tread quantiser)
+            NS = nsdcal_stream(YQns, MLns, self.Qstep, -2**(self.Nb-1)*self.Qstep, self.Nb, self.Qmodel,
+                               FILTER=self.FILTER)
             NSQ_C = np.zeros((1, Xcs.size)).astype(int)
 
+            # Continue the noise shaping loop where the interrupted run stopped
+            j_start = 0
+            if state is not None:
+                j_start = state['j']
+                NS.xns = np.array(state['xns'], dtype=np.float64).reshape(-1)
+                NS.yns = float(np.squeeze(state['yns']))
+                NSQ_C = state['NSQ_C']
+                t_start = t_start - state['t_iter']
+                state = None
+
             # Noise shaping loop
-            for j in range(0,u_dsm_inp.size):
-                w = u_dsm_inp[j] - yns[0,0]
-                u_dsm = w + Dq[j]
-
-                # Requantize
-                q_u_dsm = math.floor(u_dsm/self.Qstep + 0.5)
-                q_u_dsm_code = q_u_dsm + 2**(self.Nb-1)
-
-                # Set saturation limits
-                if q_u_dsm_code < 0: q_u_dsm_code = 0
-                if q_u_dsm_code > 2**self.Nb-1: q_u_dsm_code = 2**self.Nb -1
-
-                # Store values
-                NSQ_C[0,j] = q_u_dsm_code
-
-                # Generate DAC output
-                q_dsm_i = YQns[q_u_dsm_code]
-                q_dsm_m = MLns[q_u_dsm_code]
-
-                # Generate error
-                match self.Qmodel:
-                    case 1:
-                        e[0] = q_dsm_i - w
-                    case 2:
-                        e[0] = q_dsm_m - w
-                
-                # noise shaping filter 
-                xns = Ad@xns + Bd@e
-                yns = Cd@xns
+            for j in range(j_start, u_dsm_inp.size, self.CHUNK):
+                k = min(j + self.CHUNK, u_dsm_inp.size)
+
+                # Requantize, and set saturation limits
+                NSQ_C[0, j:k] = np.clip(NS.process(u_dsm_inp[j:k], Dq[j:k]), 0, 2**self.Nb - 1)
+
+                # Save the progress up to and including this chunk
+                if CHECKPOINT is not None and CHECKPOINT.due():
+                    CHECKPOINT.save(fp, i=i, j=k, init_u=init_u, u_dsm_inp=u_dsm_inp, ILC_C=ILC_C,
+                                    NSQ_C=NSQ_C, xns=NS.xns, yns=NS.yns, stats=self.stats[0:i],
+                                    best_C=best_C, best_rms=best_rms, t_iter=time.perf_counter() - t_start)
             #################################
 
             # DAC output
@@ -204,9 +296,38 @@ class DSM_ILC:
             # update dsm input; add generated feed forward signal to the reference/test signal
             u_dsm_inp = init_u + Xcs
 
+            # Per-iteration metrics (the error is that of the codes of this iteration)
+            rms = np.sqrt(np.mean(ilc_err**2))
+            changed = np.count_nonzero(NSQ_C != ILC_C) if i > 0 else NSQ_C.size
+            enob = np.nan
+            if ENOB_PROBE is not None and PROBE_EVERY > 0 and ((i + 1) % PROBE_EVERY == 0 or i == itr - 1):
+                enob = ENOB_PROBE(NSQ_C)
+            self.stats[i] = (rms, inband_power(ilc_err, BAND), changed, enob, time.perf_counter() - t_start)
+
             # Codes 
             ILC_C = NSQ_C
 
+            if rms < best_rms:
+                best_C, best_rms = NSQ_C, rms
+
+            # Stop criteria
+            if i > 0:
+                rms_prev = self.stats['rms_err'][i-1]
+                if DIVERGE is not None and rms > DIVERGE*best_rms:
+                    print(f'ILC diverging at iteration {i+1} (RMS error {rms:.3e}, best {best_rms:.3e}); using the best iteration')
+                    ILC_C = best_C
+                    n_itr = i + 1
+                    break
+                if TOL is not None and abs(rms - rms_prev) <= TOL*rms_prev:
+                    print(f'ILC converged at iteration {i+1} (RMS error {rms:.3e})')
+                    n_itr = i + 1
+                    break
+
+        self.stats = self.stats[0:n_itr]
+
+        if CHECKPOINT is not None:
+            CHECKPOINT.clear()
+
         return ILC_C
 
 
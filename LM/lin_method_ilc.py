@@ -16,7 +16,7 @@ import random
 import tqdm
 # from configurations import quantiser_configurations
 
-def get_control(N, N_padding, Xcs, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype, lvl_dict):
+def get_control(N, N_padding, Xcs, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype, ML):
     """
     INPUT:
         N         - Total length of reference/test signal (in sample numbers),
@@ -28,8 +28,7 @@ def get_control(N, N_padding, Xcs, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype
         Qstep     - Quantizer step size
         Q_levels  - Quantizer levels
         Qtype     - Quantizer type
-        lvl-dict  - Dictionary, where, keys represent the codes and the values represent the 
-                    quantized measured(or ideal) levels depending on the Qstep and Range of the quantizer.
+        ML        - Measured (or ideal) levels indexed by the codes, 1d array (see level_array)
     
     OUTPUT:
         US		- Control (Stacked)
@@ -38,19 +37,23 @@ def get_control(N, N_padding, Xcs, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype
         rmsErr	- RMS Error
     """
 
+    ML = level_array(ML)
+
     pMatrix = get_periodMatrix(N, N_padding, Xcs)
     N_period, T_period = pMatrix.shape  # matrix dimensions
 
-    US = np.empty([1, itr+1])
-    YS = np.empty([1, itr+1])
-    ES = np.empty([1, itr+1])
+    # Storage for the trimmed periods, one block of rows per period
+    N_trim = remove_Overlap(pMatrix[:, 0:1], N, N_padding).shape[0]
+    US = np.empty([T_period*N_trim, itr+1])
+    YS = np.empty([T_period*N_trim, itr+1])
+    ES = np.empty([T_period*N_trim, itr+1])
 
     u_init = Xcs[0]*np.ones(N_period)
 
     # for i in range(T_period):
     for i in tqdm.tqdm(range(T_period)):
         ref_signal = pMatrix[:,i]
-        U, Y, E, rE = get_ILC_control(ref_signal, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype, lvl_dict) 
+        U, Y, E, rE = get_ILC_control(ref_signal, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype, ML) 
 
         u_init = U[:,-1]  # set initial control for the next period as the optimal control of the last period
 
@@ -62,25 +65,17 @@ def get_control(N, N_padding, Xcs, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype
         E_trim = remove_Overlap(E, N, N_padding)
 
         # Store values
-        US = np.vstack((US, U_trim))
-        YS = np.vstack((YS, Y_trim))
-        ES = np.vstack((ES, E_trim))
-
-    # Remove first row
-    US = np.delete(US, 0,0)
-    YS = np.delete(YS, 0,0)
-    ES = np.delete(ES, 0,0)
-
-    # RMS Error
-    rmsErr = [] 
-    for i in range(ES.shape[1]):
-        rmsErr_i = np.sqrt(np.square(ES[:,i]).mean())
-        rmsErr = np.append(rmsErr, rmsErr_i)
+        US[i*N_trim:(i+1)*N_trim, :] = U_trim
+        YS[i*N_trim:(i+1)*N_trim, :] = Y_trim
+        ES[i*N_trim:(i+1)*N_trim, :] = E_trim
+
+    # RMS Error (per iteration)
+    rmsErr = np.sqrt(np.mean(ES**2, 0))
     
     return US
 
 
-def get_ILC_control(Xcs, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype, Mlvl_dict):
+def get_ILC_control(Xcs, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype, ML):
     """
     INPUTS:
         Xcs         - Reference / test signal
@@ -92,7 +87,7 @@ def get_ILC_control(Xcs, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype,
         Qstep       - Quantization step size
         Q_leves     - Quantizer leves
         Qtype       - Quantizer type; Ideal or Nonideal (with INL)
-        Mlvl_dict   - Measured level dictionary
+        ML          - Measured levels indexed by the codes, 1d array (see level_array)
         
     OUTPUTS:
         U       - Control matrix with values from every iteration
@@ -104,25 +99,34 @@ def get_ILC_control(Xcs, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype,
     U, Y, E [:,-1]: Each column represent each iteration.
     """
 
+    ML = level_array(ML)
+
     # Make test signal column vector
     Xcs = Xcs.reshape(-1,1)
 
+    # Storage, one column per iteration
+    U = np.empty([Xcs.size, itr+1])
+    Y = np.empty([Xcs.size, itr+1])
+    E = np.empty([Xcs.size, itr+1])
+    rmsErr = np.empty(itr+1)
+
     # Initial Control 
     # u = np.ones_like(Xcs)
     u = u_init.reshape(-1,1)
-    U = u
+    U[:, 0:1] = u
 
     # Intial Output
     y = OUT_M @ u
-    Y = y
+    Y[:, 0:1] = y
 
     # Initial Error 
     e = Xcs - y  # reference/test signal - output signal
-    E = e
+    E[:, 0:1] = e
 
     # RMS error 
-    rmse = np.sqrt((e**2).mean())
-    rmsErr = rmse
+    rmsErr[0] = np.sqrt((e**2).mean())
+
+    Vmin = np.min(Q_levels)
 
     for i in range(itr):
         # Update control using ILC algorithm, Q filter matrix and Learning matrix
@@ -132,12 +136,11 @@ def get_ILC_control(Xcs, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype,
         q_u_new = direct_quant(u_new, Qstep, Q_levels, Qtype)               
 
         # Convert quantized signal to code
-        Vmin = np.min(Q_levels)
         q_u_new_code = gen_code(q_u_new, Qstep, Vmin, Qtype).squeeze()
 
         # Parsing measured levels according to the code
-        q_u_new_dac = gen_dac_output(q_u_new_code, Mlvl_dict)
-        q_u = np.array(q_u_new_dac).reshape(-1,1)
+        q_u_new_dac = gen_dac_output(q_u_new_code, ML)
+        q_u = q_u_new_dac.reshape(-1,1)
 
         # Output 
         y = OUT_M @ q_u
@@ -147,13 +150,12 @@ def get_ILC_control(Xcs, u_init, itr, QF_M, L_M, OUT_M, Qstep, Q_levels, Qtype,
         e = Xcs - y 
 
         # Store values 
-        Y = np.hstack((Y, y))
-        U = np.hstack((U, u_new))
-        E = np.hstack((E, e))         
+        Y[:, i+1:i+2] = y
+        U[:, i+1:i+2] = u_new
+        E[:, i+1:i+2] = e
 
         # Rms Error 
-        rmse = np.sqrt(((e**2).mean()))
-        rmsErr = np.hstack((rmsErr, rmse))
+        rmsErr[i+1] = np.sqrt(((e**2).mean()))
 
         # Update control 
         u = u_new.reshape(-1,1)
@@ -223,32 +225,19 @@ def get_periodMatrix(N, N_padding, ref_signal):
 
     N_period = int(N + 2*N_padding)       # Total samples in each period (signal length + padding length)
 
-    # Reference signal period  matrix: Each row contains the reference signal with N_total samples (an arbitrary period)  
-
-    # N-length signal storage container , first entry
-    period_matrix =  ref_signal[0:N_period] 
-
-    # Transform to column matrix to store in matrix
-    period_matrix = period_matrix.reshape(len(period_matrix),1) 
-
-    # Initial index for second period
-    index_init = N_period 
+    # Reference signal period  matrix: Each column contains the reference signal with N_total samples (an arbitrary period)  
 
     if len(ref_signal) <= N_period-1:
         raise ValueError('Length of reference signal less than the lenght of the period length')
-    else:
-        while True:
-            # indices for each iteration 
-            index1 = int(index_init - N_padding)      # inital index for ith period
-            index2 = int(index1 + N_period)              # final index for ith period
-
-            # makes the periods of reference signal of same length and store them as matrix
-            if index2 <= len(ref_signal):
-                vec_i = np.reshape(ref_signal[index1:index2],(N_period,1)) 
-                period_matrix = np.hstack((period_matrix, vec_i))
-            else:
-                break
-            index_init = index2        # update index
+
+    # Consecutive periods overlap by N_padding samples, period k starts at k*(N_period - N_padding)
+    N_step = int(N_period - N_padding)
+    T_period = (len(ref_signal) - N_period)//N_step + 1
+
+    period_matrix = np.empty((N_period, T_period))
+    for k in range(T_period):
+        index1 = k*N_step      # inital index for kth period
+        period_matrix[:, k] = ref_signal[index1:index1 + N_period]
     return period_matrix 
 
 
@@ -321,23 +310,40 @@ def gen_code(q_Xcs, Qstep, Vmin, Qtype):
     return q_code.astype(int)
 
 
-def gen_dac_output(q_codes, ML_dict):
+def gen_dac_output(q_codes, ML):
     """ 
     INPUTS:
         q_codes       - quantized signal in codes
-        ML_dict       - measured levels corresponding to the code, LUT
+        ML            - measured levels indexed by the codes, LUT (1d array)
 
     OUTPUTS:
         q_dac       -  Emulated DAC output 
     """
 
-    q_dac = []
-    for i in q_codes:
-        q_dac_i = ML_dict[i]    # assing value to the code
-        q_dac.append(q_dac_i)
+    q_dac = np.take(ML, q_codes)    # assign values to the codes
     return  q_dac
 
 
+def level_array(ML):
+    """ Levels as a contiguous 1d array indexed by the codes.
+
+    INPUTS:
+        ML      - levels, array (1d, or a single row/column), or dictionary of code: level
+                  with the codes 0, 1, ..., 2^Nb - 1
+
+    OUTPUTS:
+        ML      - levels, contiguous 1d array
+    """
+    if isinstance(ML, dict):
+        codes = np.fromiter(ML.keys(), dtype=int)
+        if not np.array_equal(np.sort(codes), np.arange(codes.size)):
+            raise ValueError('Level dictionary keys must be the codes 0, 1, ..., 2^Nb - 1.')
+        lvls = np.empty(codes.size)
+        lvls[codes] = np.fromiter(ML.values(), dtype=float)
+        ML = lvls
+    return np.ascontiguousarray(ML, dtype=np.float64).reshape(-1)
+
+
 def generate_ML(Nb, Qstep, Q_levels):
     # Generate random INL for the simulation
     
@@ -349,5 +355,4 @@ def generate_ML(Nb, Qstep, Q_levels):
     inl[0:2] = 0
     inl[-2:] = 0
     ml = Q_levels + inl
-    ML_dict = dict(zip(level_codes, ml))
-    return ML_dict
+    return level_array(ml)  # indexed by level_codes
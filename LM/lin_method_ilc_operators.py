@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Structured (matrix-free) ILC learning operators for diagonal weights.
+
+The plant matrix G of the ILC is lower-triangular Toeplitz (the reconstruction filter
+impulse response), so G, G^T, and the Q-filter and learning matrices
+
+    Q = (G^T We G + Wf + Wdf)^-1 (G^T We G + Wdf)
+    L = (G^T We G + Wdf)^-1 G^T We
+
+can be applied with FFT convolutions and conjugate-gradient solves, preconditioned
+by the circulant approximation of G. Memory is O(N) and time O(N log N) per iteration,
+instead of the O(N^2) memory and O(N^3) time of the dense matrices.
+
+@author: Arnfinn Aas Eielsen
+@date: 18.10.2026
+@license: BSD 3-Clause
+"""
+
+import numpy as np
+from scipy.sparse.linalg import LinearOperator, aslinearoperator, cg, eigs, eigsh, ArpackNoConvergence
+
+from utils.checkpoint import fingerprint
+
+
+class toeplitz_op(LinearOperator):
+    """
+    Lower-triangular Toeplitz matrix (causal convolution with h) applied by FFT.
+    :param h: Impulse response (first column), truncated/padded to N
+    :param N: Signal length
+    """
+    def __init__(self, h, N):
+        self.h = np.zeros(N)
+        h = np.asarray(h, dtype=np.float64).reshape(-1)[0:N]
+        self.h[0:h.size] = h
+        self.nfft = 2*N  # linear (not circular) convolution
+        self.Hf = np.fft.rfft(self.h, self.nfft)
+        super().__init__(np.float64, (N, N))
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        return np.fft.irfft(self.Hf*np.fft.rfft(x, self.nfft), self.nfft)[0:self.shape[0]]
+
+    def _rmatvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        return np.fft.irfft(np.conj(self.Hf)*np.fft.rfft(x, self.nfft), self.nfft)[0:self.shape[0]]
+
+
+class ilc_solve_op(LinearOperator):
+    """
+    x -> (G^T We G + Wa)^-1 (G^T We G + Wb) x, or x -> (G^T We G + Wa)^-1 G^T We x (Wb = None).
+    Solved by preconditioned conjugate-gradients (SOLVER='pcg'), or by the circulant
+    approximation alone (SOLVER='circulant').
+    """
+    def __init__(self, G, We, Wa, Wb, Hc, SOLVER='pcg', RTOL=1e-12):
+        N = G.shape[0]
+        self.G, self.We, self.Wa, self.Wb = G, We, Wa, Wb
+        self.SOLVER = SOLVER
+        self.RTOL = RTOL
+        self.iterations = []  # CG iterations per solve
+
+        # System matrix, and its circulant approximation (mean weights) as preconditioner
+        self.A = LinearOperator((N, N), matvec=lambda x: self.normal(x) + Wa*x.reshape(-1), dtype=np.float64)
+        Pf = np.mean(We)*np.abs(Hc)**2 + np.mean(Wa)
+        self.Pf = Pf
+        self.M = LinearOperator((N, N), matvec=lambda x: np.fft.irfft(np.fft.rfft(x.reshape(-1))/Pf, N), dtype=np.float64)
+
+        super().__init__(np.float64, (N, N))
+
+    def normal(self, x):
+        # G^T We G x
+        return self.G.rmatvec(self.We*self.G.matvec(x.reshape(-1)))
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        if self.Wb is None:
+            b = self.G.rmatvec(self.We*x)
+        else:
+            b = self.normal(x) + self.Wb*x
+
+        return self.solve(b)
+
+    def _rmatvec(self, x):
+        # The system matrices are symmetric, so the transpose swaps the order of the factors
+        y = self.solve(np.asarray(x, dtype=np.float64).reshape(-1))
+        if self.Wb is None:
+            return self.We*self.G.matvec(y)
+        else:
+            return self.normal(y) + self.Wb*y
+
+    def solve(self, b):
+        # (G^T We G + Wa)^-1 b
+        match self.SOLVER:
+            case 'pcg':
+                it = [0]
+                def count(xk): it[0] += 1
+                y, info = cg(self.A, b, x0=self.M.matvec(b), rtol=self.RTOL, M=self.M, callback=count)
+                if info > 0:
+                    print(f'warning: ILC CG solve did not converge ({info} iterations)')
+                self.iterations.append(it[0])
+            case 'circulant':
+                y = self.M.matvec(b)
+            case _:
+                raise ValueError('Unknown ILC solver.')
+
+        return y
+
+
+def ilc_learning_operators(h, N, We, Wf, Wdf, SOLVER='pcg', RTOL=1e-12):
+    """
+    Structured Q-filter, learning and plant operators for diagonal weights.
+
+    Arguments
+        h - reconstruction filter impulse response
+        N - signal length
+        We, Wf, Wdf - diagonal tuning weights, scalars or 1d arrays of length N
+        SOLVER - 'pcg' (preconditioned conjugate-gradients), or 'circulant' (approximation)
+        RTOL - relative tolerance of the CG solves
+
+    Returns
+        Q, L, G - LinearOperators; Q@x, L@x and G@x as for the dense matrices
+    """
+    We, Wf, Wdf = [np.broadcast_to(np.asarray(W, dtype=np.float64), (N,)) for W in [We, Wf, Wdf]]
+
+    G = toeplitz_op(h, N)
+    Hc = np.fft.rfft(G.h)  # circulant approximation of G (N-point)
+
+    Q = ilc_solve_op(G, We, Wf + Wdf, Wdf, Hc, SOLVER, RTOL)
+    L = ilc_solve_op(G, We, Wdf, None, Hc, SOLVER, RTOL)
+    G.Hc = Hc
+
+    # Inputs identifying the operators (for checkpoints)
+    fp = fingerprint(G.h, We, Wf, Wdf, SOLVER, RTOL)
+    for M in [Q, L, G]:
+        M.fingerprint = fp
+
+    return Q, L, G
+
+
+class circulant_op(LinearOperator):
+    """
+    Circulant matrix (periodic convolution over N samples), given by its DFT response per bin.
+    :param D: Response per frequency bin (rfft bins, N//2+1)
+    :param N: Signal length (one period)
+    """
+    def __init__(self, D, N):
+        self.D = D
+        super().__init__(np.float64, (N, N))
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        return np.fft.irfft(self.D*np.fft.rfft(x), self.shape[0])
+
+    def _rmatvec(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+        return np.fft.irfft(np.conj(self.D)*np.fft.rfft(x), self.shape[0])
+
+
+def ilc_periodic_operators(h, N, We, Wf, Wdf):
+    """
+    Lifted ILC for a periodic reference: over one period (N samples, coherent sampling) the
+    plant in periodic steady state is circulant, so the DFT diagonalises G, Q and L and the
+    update is applied per frequency bin,
+
+        U(k) <- q(k) (U(k) + l(k) E(k)),  with
+        q = (We |H|^2 + Wdf)/(We |H|^2 + Wf + Wdf),  l = We conj(H)/(We |H|^2 + Wdf).
+
+    Arguments
+        h - reconstruction filter impulse response (folded modulo N)
+        N - signal length, one or more whole periods of the reference
+        We, Wf, Wdf - tuning weights, scalars or per-bin arrays (N//2+1)
+
+    Returns
+        Q, L, G - circulant operators; Q@x, L@x and G@x as for matrices
+        rho - convergence factor per bin, |q (1 - l H)|; the ILC converges if all are < 1
+    """
+    h = np.asarray(h, dtype=np.float64).reshape(-1)
+    hp = np.zeros(int(np.ceil(h.size/N))*N)
+    hp[0:h.size] = h
+    hp = hp.reshape(-1, N).sum(0)  # periodic impulse response
+
+    H = np.fft.rfft(hp)
+    g = We*np.abs(H)**2
+    q = (g + Wdf)/(g + Wf + Wdf)
+    l = We*np.conj(H)/(g + Wdf)
+    rho = np.abs(q*(1 - l*H))
+
+    Q, L, G = circulant_op(q + 0j, N), circulant_op(l, N), circulant_op(H, N)
+
+    # Inputs identifying the operators (for checkpoints)
+    fp = fingerprint(hp, We, Wf, Wdf, 'periodic')
+    for M in [Q, L, G]:
+        M.fingerprint = fp
+
+    return Q, L, G, rho
+
+
+def ilc_uniform_margin(We, Wf, Wdf, G_MIN=0.0):
+    """
+    Certificate for uniform weights (scalar multiples of the identity). With S = We G^T G,
+    Q = (S + Wf + Wdf)^-1 (S + Wdf) and I - L G = (S + Wdf)^-1 Wdf commute, so the error
+    dynamics matrix A = Q (I - L G) = Wdf (S + Wf + Wdf)^-1 is symmetric with eigenvalues
+
+        f(s) = Wdf/(s + Wf + Wdf),  s in spec(S),
+
+    decreasing in s, and ||A||_2 = rho(A) <= f(We G_MIN^2), for any lower bound G_MIN of the
+    smallest singular value of G (0 if unknown), with equality if G_MIN is that singular value.
+
+    Returns
+        margin - 1 - f(We G_MIN^2), both margins of ilc_certificate (a lower bound for a lower G_MIN)
+    """
+    return 1 - Wdf/(We*G_MIN**2 + Wf + Wdf)
+
+
+def ilc_error_operator(Q, L, G):
+    """
+    Error dynamics matrix A = Q (I - L G) of the ILC iteration u <- Q (u + L e), e = r - G u,
+    as a LinearOperator.
+    """
+    Q, L, G = [aslinearoperator(M) for M in [Q, L, G]]
+    N = G.shape[0]
+
+    def matvec(x):
+        return Q.matvec(x - L.matvec(G.matvec(x)))
+
+    def rmatvec(x):
+        y = Q.rmatvec(x)
+        return y - G.rmatvec(L.rmatvec(y))
+
+    return LinearOperator((N, N), matvec=matvec, rmatvec=rmatvec, dtype=np.float64)
+
+
+def ilc_norm(A, TOL=1e-6, MAXITER=300):
+    """
+    ||A||_2 from Lanczos iterations on A^T A (an estimate), NaN if they do not converge.
+    """
+    N = A.shape[0]
+    AtA = LinearOperator((N, N), matvec=lambda x: A.rmatvec(A.matvec(x)), dtype=np.float64)
+    try:
+        return np.sqrt(eigsh(AtA, k=1, which='LM', tol=TOL, maxiter=MAXITER, return_eigenvectors=False)[0])
+    except ArpackNoConvergence:
+        print(f'warning: ILC certificate, Lanczos did not converge ({MAXITER} iterations)')
+        return np.nan
+
+
+def ilc_certificate(Q, L, G, METHOD='auto', TOL=1e-6, MAXITER=300):
+    """
+    Stability and monotonic-convergence certificate of the ILC iteration u <- Q (u + L e),
+    e = r - G u, i.e. of the error dynamics matrix A = Q (I - L G), without a full
+    eigendecomposition.
+
+        monotonic convergence (in the 2-norm): ||A||_2 < 1, which also implies stability
+        stability (asymptotic convergence): spectral radius rho(A) < 1
+
+    For the Toeplitz operators (diagonal weights) A = (G^T We G + Wf + Wdf)^-1 Wdf is similar
+    to a symmetric matrix <= diag(Wdf/(Wf + Wdf)), so rho(A) <= max Wdf/(Wf + Wdf) always, and
+    ||A||_2 <= max Wdf/min(Wf + Wdf). These bounds ignore G, so they are loose, and are only
+    used where the estimates below are not available.
+
+    Arguments
+        Q, L, G - dense matrices, or operators (see ilc_learning_operators, ilc_periodic_operators)
+        METHOD
+            'frequency': per-bin factors |q (1 - l H)| for the periodic operators (exact); for the
+                Toeplitz operators with uniform weights ilc_uniform_margin, with the smallest
+                singular value of G estimated by min |H| of its circulant approximation (the
+                limit for long signals and minimum-phase plants)
+            'lanczos': ||A||_2 from Lanczos iterations on A^T A; rho(A) by Arnoldi, only if the
+                norm does not already certify stability (estimates, slow for clustered spectra)
+            'auto': 'frequency' where it applies, otherwise 'lanczos'
+        TOL, MAXITER - tolerance and iteration limit of the Lanczos/Arnoldi iterations; if they
+            do not converge, the exact norm/eigenvalues are computed for dense matrices, the
+            bounds above are used for the Toeplitz operators (NaN if the norm bound is >= 1),
+            and the margins are NaN for other operators
+
+    Returns
+        margin_s - stability margin 1 - rho(A), satisfied if >= 0 (NaN if unknown)
+        margin_m - monotonic convergence margin 1 - ||A||_2, satisfied if >= 0 (NaN if unknown)
+    """
+    toeplitz = isinstance(G, toeplitz_op)
+    uniform = toeplitz and all(np.ptp(W) == 0 for W in [Q.We, Q.Wa, Q.Wb])
+
+    if METHOD == 'auto':
+        METHOD = 'frequency' if isinstance(G, circulant_op) or uniform else 'lanczos'
+
+    match METHOD:
+        case 'frequency':
+            if isinstance(G, circulant_op):
+                # A is circulant, hence normal, so the norm equals the spectral radius
+                margin = 1 - np.max(np.abs(Q.D*(1 - L.D*G.D)))
+            elif uniform:
+                margin = ilc_uniform_margin(Q.We[0], Q.Wa[0] - Q.Wb[0], Q.Wb[0], np.min(np.abs(G.Hc)))
+            else:
+                raise ValueError('The frequency certificate needs periodic operators, or Toeplitz operators with uniform weights.')
+            return margin, margin
+        case 'lanczos':
+            dense = all(isinstance(M, np.ndarray) for M in [Q, L, G])  # exact fallback
+            if toeplitz:
+                Wf, Wdf = Q.Wa - Q.Wb, Q.Wb
+                rho_ub = np.max(Wdf/(Wf + Wdf))
+                nrm_ub = rho_ub if np.ptp(Wdf) == 0 else np.max(Wdf)/np.min(Wf + Wdf)  # A symmetric for uniform Wdf
+
+            A = ilc_error_operator(Q, L, G)
+            nrm = ilc_norm(A, TOL, MAXITER)
+            if np.isnan(nrm):
+                if dense:
+                    nrm = np.linalg.norm(Q - Q@L@G, 2)
+                elif toeplitz:
+                    return 1 - rho_ub, 1 - nrm_ub if nrm_ub < 1 else np.nan
+                else:
+                    return np.nan, np.nan
+            if toeplitz:
+                rho = min(nrm, rho_ub)
+            elif nrm < 1:
+                rho = nrm  # rho(A) <= ||A||_2
+            else:
+                try:
+                    rho = np.abs(eigs(A, k=1, which='LM', tol=TOL, maxiter=MAXITER, return_eigenvectors=False)[0])
+                except ArpackNoConvergence:
+                    if not dense:
+                        print(f'warning: ILC certificate, Arnoldi did not converge ({MAXITER} iterations)')
+                        return np.nan, 1 - nrm
+                    rho = np.max(np.abs(np.linalg.eigvals(Q - Q@L@G)))
+            return 1 - rho, 1 - nrm
+        case _:
+            raise ValueError('Unknown ILC certificate method.')
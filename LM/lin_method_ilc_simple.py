@@ -12,6 +12,7 @@ This is amongst the simplest ILC implementations.
 
 # %%
 import numpy as np
+import itertools
 from scipy import signal
 from matplotlib import pyplot as plt
 
@@ -22,32 +23,40 @@ from utils.quantiser_configurations import quantiser_configurations, qs
 def ilc_simple(r, G, Qfilt, Qstep, Nb, Qtype=quantiser_type.midtread, kp=0.25, kd=10.0, Niter=25):
     """
     ILC using PD-type learning filter
+
+    The plant is simulated with second-order sections (converted once, see plant_sos), the
+    Q filter with overlap-add FFT convolution, and the iteration buffers are reused.
     """
 
     Dq = dither_generation.gen_stochastic(r.size, 1, Qstep, dither_generation.pdf.triangular_hp)
     Dq = Dq.squeeze()
 
-    M = Qfilt.size
-    MM = int((M-1)/2)
+    sos = plant_sos(G)
 
     rq = quantise_signal(r + Dq, Qstep, Qtype)
-    y0_out = signal.dlsim(G, Qstep*rq)  # initial open-loop response
-    y0 = y0_out[1].flatten()
+    y0 = signal.sosfilt(sos, Qstep*rq)  # initial open-loop response
 
-    e0 = r - y0  # initial error
-    e = np.insert(e0, 0, 0.0)  # pad for D term
+    # Iteration buffers
+    e = np.zeros(r.size + 1)  # error, padded for D term
+    s = np.zeros(r.size)  # learning filter output
+    w = np.zeros(r.size)  # quantiser input
+    uq = np.zeros(r.size)  # quantised control
+
+    np.subtract(r, y0, out=e[1:])  # initial error
     print(e.size)
 
     u = np.zeros(r.size)  # init
     for j in range(1, Niter): 
-        s = u + kp*e[1:] + kd*np.diff(e)
-        u = np.convolve(Qfilt, s)  # Q filter (zero-phase)
-        u = u[MM:-MM]
-        uq = quantise_signal(u + Dq, Qstep, Qtype)
-        y1_out = signal.dlsim(G, Qstep*uq)
-        y1 = y1_out[1].flatten()
-        e1 = r - y1
-        e = np.insert(e1, 0, 0.0) # pad for D term
+        np.subtract(e[1:], e[:-1], out=s)  # D term
+        s *= kd
+        s += kp*e[1:]
+        s += u
+        u = signal.oaconvolve(s, Qfilt, mode='same')  # Q filter (zero-phase)
+        np.add(u, Dq, out=w)
+        quantise_signal(w, Qstep, Qtype, out=uq)
+        np.multiply(uq, Qstep, out=w)
+        y1 = signal.sosfilt(sos, w)
+        np.subtract(r, y1, out=e[1:])
 
     # Generate codes
     c = generate_codes(uq, Nb, Qtype)
@@ -55,6 +64,134 @@ def ilc_simple(r, G, Qfilt, Qstep, Nb, Qtype=quantiser_type.midtread, kp=0.25, k
     return c, y1
 
 
+def ilc_simple_tune(r, G, Qstep, Nb, Qtype, Fs, KP, KD, Q_FC, M=2001, Niter=25, PRUNE_AFTER=5, DIVERGE=2.0,
+                    ENOB_PROBE=None, BATCH=8):
+    """
+    Tune ilc_simple over a grid of (kp, kd, Q-filter cut-off) candidates. The candidates are
+    stacked as rows and advanced through the iterations together (same dither, and the same
+    iteration as ilc_simple for each row). A candidate is pruned, from iteration PRUNE_AFTER,
+    when its RMS error exceeds DIVERGE times the best of its earlier iterations (after the first
+    learning step, which usually overshoots), and the open-loop error (not a fluctuation at the
+    quantisation noise floor).
+
+    Arguments
+        r, G, Qstep, Nb, Qtype - as for ilc_simple
+        Fs - sampling frequency (for the Q-filter design)
+        KP, KD, Q_FC - grids of proportional and derivative gains and Q-filter cut-offs (Hz)
+        M - Q-filter support (taps)
+        Niter - number of iterations (as for ilc_simple)
+        PRUNE_AFTER, DIVERGE - pruning of diverging candidates (from iteration 2 at the earliest)
+        ENOB_PROBE - function of the codes returning the ENOB (e.g. through the static DAC model)
+        BATCH - candidates per batch (bounds the memory, a few signal-length rows per candidate)
+
+    Returns
+        table - per candidate: kp, kd, Q_Fc, iterations, final RMS error, convergence rate (mean
+                RMS error ratio per iteration, after the first), ENOB, status; best first
+        best - (kp, kd, Q_Fc) of the best candidate (highest ENOB, else lowest RMS error)
+    """
+    Dq = dither_generation.gen_stochastic(r.size, 1, Qstep, dither_generation.pdf.triangular_hp)
+    Dq = Dq.squeeze()
+
+    sos = plant_sos(G)
+
+    rq = quantise_signal(r + Dq, Qstep, Qtype)
+    y0 = signal.sosfilt(sos, Qstep*rq)  # initial open-loop response
+    e0 = r - y0
+
+    P = np.array(list(itertools.product(KP, KD, Q_FC)), dtype=float)  # candidates
+    R = P.shape[0]
+    rms = np.full((R, Niter), np.nan)  # RMS error per iteration (initial error first)
+    rms[:, 0] = np.sqrt(np.mean(e0**2))
+    n_itr = np.ones(R, dtype=int)
+    enob = np.full(R, np.nan)
+    diverged = np.zeros(R, dtype=bool)
+
+    for b in range(0, R, BATCH):
+        idx = np.arange(b, min(b + BATCH, R))  # candidates in the batch (not pruned)
+        kp, kd = P[idx, 0:1], P[idx, 1:2]
+        Qfilt = np.stack([gaussian_qfilter(M, Q_Fc, Fs) for Q_Fc in P[idx, 2]])
+
+        # Iteration buffers, one row per candidate
+        e = np.zeros((idx.size, r.size + 1))  # error, padded for D term
+        e[:, 1:] = e0
+        s = np.zeros((idx.size, r.size))  # learning filter output
+        w = np.zeros((idx.size, r.size))  # quantiser input
+        uq = np.zeros((idx.size, r.size))  # quantised control
+        u = np.zeros((idx.size, r.size))
+
+        for j in range(1, Niter):
+            np.subtract(e[:, 1:], e[:, :-1], out=s)  # D term
+            s *= kd
+            s += kp*e[:, 1:]
+            s += u
+            u = signal.oaconvolve(s, Qfilt, mode='same', axes=-1)  # Q filter (zero-phase)
+            np.add(u, Dq, out=w)
+            quantise_signal(w, Qstep, Qtype, out=uq)
+            np.multiply(uq, Qstep, out=w)
+            y1 = signal.sosfilt(sos, w, axis=-1)
+            np.subtract(r, y1, out=e[:, 1:])
+
+            rms[idx, j] = np.sqrt(np.mean(e[:, 1:]**2, 1))
+            n_itr[idx] = j + 1
+
+            # Prune diverging candidates (compared with at least one earlier learning step)
+            if j >= max(PRUNE_AFTER, 2):
+                bad = (rms[idx, j] > DIVERGE*np.min(rms[idx, 1:j], 1)) & (rms[idx, j] > rms[idx, 0])
+                if np.any(bad):
+                    diverged[idx[bad]] = True
+                    keep = ~bad
+                    idx, kp, kd, Qfilt, e, s, w, uq, u = [V[keep] for V in [idx, kp, kd, Qfilt, e, s, w, uq, u]]
+                    if idx.size == 0:
+                        break
+
+        # Generate codes, and probe the ENOB
+        if ENOB_PROBE is not None:
+            for k, c in zip(idx, generate_codes(uq, Nb, Qtype)):
+                enob[k] = ENOB_PROBE(c.reshape(1, -1))
+
+    rms_last = rms[np.arange(R), n_itr - 1]
+    rate = (rms_last/rms[:, min(1, Niter - 1)])**(1/np.maximum(n_itr - 2, 1))
+
+    # Best first: converged candidates by ENOB (if probed) or final RMS error
+    order = np.lexsort((rms_last, -np.nan_to_num(enob, nan=-np.inf), diverged))
+
+    table = [['kp', 'kd', 'Q_Fc', 'Iterations', 'RMS error', 'Rate', 'ENOB', 'Status']]
+    for k in order:
+        table.append([f'{P[k, 0]:g}', f'{P[k, 1]:g}', f'{P[k, 2]:.3g}', f'{n_itr[k]}',
+                      f'{rms_last[k]:.3e}', f'{rate[k]:.4f}',
+                      f'{enob[k]:.3f}' if not np.isnan(enob[k]) else '-',
+                      'diverged' if diverged[k] else 'ok'])
+
+    best = tuple(P[order[0]])
+
+    return table, best
+
+
+def gaussian_qfilter(M, Q_Fc, Fs):
+    """
+    Gaussian (zero-phase FIR) Q filter with M taps (odd) and cut-off Q_Fc (Hz), unit DC gain.
+    """
+    alpha = (np.sqrt(2)*np.pi*Q_Fc*M)/(Fs*np.sqrt(np.log(4)))
+    sigma = (M - 1)/(2*alpha)
+    Qfilt = signal.windows.gaussian(M, sigma)
+    return Qfilt/np.sum(Qfilt)
+
+
+def plant_sos(G):
+    """
+    Discrete-time plant (dlti, e.g. a ZOH discretisation) as second-order sections for
+    sosfilt. The sections represent the plant without its input-output delay, so the delay
+    of a strictly proper plant is appended as z^-1 sections.
+    """
+    Gtf = G.to_tf()
+    num = np.trim_zeros(np.atleast_1d(np.squeeze(Gtf.num)), 'f')
+    den = np.atleast_1d(np.squeeze(Gtf.den))
+
+    sos = signal.tf2sos(num, den)
+    delay = np.array([[0.0, 1.0, 0.0, 1.0, 0.0, 0.0]])  # z^-1
+    return np.vstack([sos] + [delay]*(den.size - num.size))
+
+
 def plot_freq_resp(H):
     w, h = signal.freqz(H)
     w = w/(np.pi)
@@ -142,10 +279,7 @@ def main():
     # Q filter
     M = 2001  # Support/filter length/no. of taps
     Q_Fc = 2.0e4  # Cut-off freq. (Hz)
-    alpha = (np.sqrt(2)*np.pi*Q_Fc*M)/(Fs*np.sqrt(np.log(4)))
-    sigma = (M - 1)/(2*alpha)
-    Qfilt = signal.windows.gaussian(M, sigma)
-    Qfilt = Qfilt/np.sum(Qfilt)
+    Qfilt = gaussian_qfilter(M, Q_Fc, Fs)
 
     plot_freq_resp(Qfilt)
 
@@ -171,8 +305,7 @@ def main():
     #rq = Qstep*np.floor(r/Qstep + 0.5)  # mid-tread quantiser
     rq = quantise_signal(r, Qstep, quantiser_type.midtread)
 
-    y0_out = signal.dlsim(G, Qstep*rq)  # initial open-loop response
-    y0 = y0_out[1].flatten()
+    y0 = signal.sosfilt(plant_sos(G), Qstep*rq)  # initial open-loop response
 
     Ntrans = round(tau/(2*Ts))
 
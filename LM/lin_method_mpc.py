@@ -11,9 +11,17 @@ import numpy as np
 from scipy import linalg , signal
 import sys
 import random
-import gurobipy as gp
-from gurobipy import GRB
+try:
+    import gurobipy as gp
+    from gurobipy import GRB
+except ImportError:  # optional, only needed when solving
+    gp = None
 import tqdm
+import itertools
+
+from LM.lin_method_util import prediction_matrices, horizon_cost, mhoq_stats, saturation_limited
+import time
+from utils.quantiser_configurations import level_index
 
 
 class MPC:
@@ -34,6 +42,9 @@ class MPC:
         self.B = B
         self.C = C
         self.D = D
+
+        # Lifted prediction matrices for each horizon used
+        self.pred_mats = {}
     
         
     def state_prediction(self, st, con):
@@ -49,8 +60,48 @@ class MPC:
         return Xs
 
     
+    def prediction_matrices(self, N_PRED):
+        """
+        Lifted prediction matrices of the reconstruction filter over the horizon,
+        computed once per filter and horizon (see lin_method_util.prediction_matrices).
+        """
+        if N_PRED not in self.pred_mats:
+            self.pred_mats[N_PRED] = prediction_matrices(self.A, self.B, self.C, self.D, N_PRED)
+        return self.pred_mats[N_PRED]
+
+    def scaled_levels(self, YQns, MLns):
+        """
+        Levels scaled to the code range, according to the quantiser model.
+        """
+        INL = YQns - MLns
+
+        match self.QMODEL:
+            case 1:
+                QLS = (YQns /self.Qstep ) + 2**(self.Nb-1) -1/2
+                QLS = QLS.squeeze()
+            case 2:
+                QLS = (YQns /self.Qstep ) + 2**(self.Nb-1) -1/2
+                QLS = QLS + INL
+                QLS = QLS.squeeze()
+
+        return QLS
+
     # def get_codes(self, Xcs, N_PRED, YQns, MLns)
-    def get_codes(self, N_PRED, Xcs, YQns, MLns ):
+    def get_codes(self, N_PRED, Xcs, YQns, MLns, SOLVER='gurobi', REFINE_K=0):
+        """
+        Compute the codes using a moving horizon.
+        :param SOLVER: 'gurobi' - MIQP per sample, 'gurobi_persistent' - one MIQP for the run, updated per sample,
+                       'gurobi_condensed' - MIQP in the codes only (no state variables),
+                       'relaxed' - relaxed solution rounded to the levels (approximate, no solver needed)
+        :param REFINE_K: 'relaxed' only; search +/- REFINE_K levels around the rounded sequence
+        """
+
+        if SOLVER == 'gurobi_persistent':
+            return self.get_codes_persistent(N_PRED, Xcs, YQns, MLns)
+        if SOLVER == 'gurobi_condensed':
+            return self.get_codes_condensed(N_PRED, Xcs, YQns, MLns)
+        if SOLVER == 'relaxed':
+            return self.get_codes_relaxed(N_PRED, Xcs, YQns, MLns, REFINE_K)
 
         # Scale the input to the quantizer levels to run it as an MILP
         Xs = Xcs.squeeze()
@@ -66,27 +117,22 @@ class MPC:
         #     case 2:
         #         QLS = (MLns /self.Qstep ) + 2**(self.Nb-1) -1/2
         #         QLS = QLS.squeeze()
-        INL = YQns - MLns
-
-        match self.QMODEL:
-            case 1:
-                QLS = (YQns /self.Qstep ) + 2**(self.Nb-1) -1/2
-                QLS = QLS.squeeze()
-            case 2:
-                QLS = (YQns /self.Qstep ) + 2**(self.Nb-1) -1/2
-                QLS = QLS + INL
-                QLS = QLS.squeeze()
+        QLS = self.scaled_levels(YQns, MLns)
         # match self.QMODEL:
         #     case 1:
         #         QLS = self.q_scaling(YQns.reshape(1,-1)).squeeze()
         #     case 2:
         #         QLS = self.q_scaling(MLns.reshape(1,-1)).squeeze()
-        # Storage container for code
-        C = []
-
         # Loop length
         len_MPC = X.size - N_PRED
 
+        # Storage container for code, and per-step record (timing and solver statistics)
+        C = np.zeros(len_MPC).astype(int)
+        self.stats = mhoq_stats(len_MPC)
+
+        # Lifted prediction matrices (for the saturation flag)
+        Phi, Gamma = self.prediction_matrices(N_PRED)
+
         # State dimension
         x_dim =  int(self.A.shape[0]) 
 
@@ -95,6 +141,7 @@ class MPC:
 
         # MPC loop
         for j in tqdm.tqdm(range(len_MPC)):
+            t_step = time.perf_counter()
 
             env = gp.Env(empty=True)
             env.setParam("OutputFlag",0)
@@ -137,7 +184,9 @@ class MPC:
             # m.Params.IntegralityFocus = 1
 
             # Optimization 
+            t_start = time.perf_counter()
             m.optimize()
+            t_solve = time.perf_counter() - t_start
 
             # Extract variable values 
             allvars = m.getVars()
@@ -152,7 +201,11 @@ class MPC:
             C_MPC = C_MPC.astype(int)
 
             # Store only the first value /code
-            C.append(C_MPC[0])
+            C[j] = C_MPC[0]
+
+            # Saturation flag, from the free response over the horizon
+            r = (Phi @ init_state).squeeze(axis=1) - Gamma @ X[j:j+N_PRED]
+            sat = saturation_limited(r, Gamma, C_MPC, 0, 2**self.Nb-1)
 
             # Get DAC level according to the coe
             U_opt = QLS[C_MPC[0]] 
@@ -164,7 +217,274 @@ class MPC:
             # State update for subsequent prediction horizon 
             init_state = x0_new
 
-        return np.array(C).reshape(1,-1)
+            # Per-step record (see lin_method_util.mhoq_stats_dtype); the model is built for every sample
+            t_build = t_start - t_step
+            t_step = time.perf_counter() - t_step
+            self.stats[j] = (t_build, t_solve, t_step, int(m.NodeCount), m.MIPGap, sat, False)
+
+        return C.reshape(1,-1)
+
+    def get_codes_persistent(self, N_PRED, Xcs, YQns, MLns):
+        """
+        Same MIQP as get_codes, but the Gurobi environment and model are built once per run.
+        Only the right-hand sides that change per sample are updated, i.e. the initial
+        state and the reference window X[j:j+N_PRED], and each solve is warm-started
+        from the previous solution shifted by one sample.
+        """
+
+        # Scale the input to the quantizer levels to run it as an MILP
+        X = self.q_scaling(Xcs)
+
+        QLS = self.scaled_levels(YQns, MLns)
+
+        # Loop length
+        len_MPC = X.size - N_PRED
+
+        # Storage container for code, and per-step record (timing and solver statistics)
+        C = np.zeros(len_MPC).astype(int)
+        self.stats = mhoq_stats(len_MPC)
+
+        # Lifted prediction matrices (for the saturation flag)
+        Phi, Gamma = self.prediction_matrices(N_PRED)
+
+        # State dimension
+        x_dim =  int(self.A.shape[0]) 
+
+        # Initial state
+        init_state = np.zeros(x_dim).reshape(-1,1)
+
+        with gp.Env(empty=True) as env:
+            env.setParam("OutputFlag",0)
+            env.start()
+            with gp.Model("MPC- INL", env = env) as m:
+                u = m.addMVar(N_PRED, vtype=GRB.INTEGER, name= "u", lb = 0, ub =  2**self.Nb-1) # control variable
+                x = m.addMVar((x_dim*(N_PRED+1),1), vtype= GRB.CONTINUOUS, lb = -GRB.INFINITY, ub = GRB.INFINITY, name = "x")  # State varible 
+                e = m.addMVar(N_PRED, vtype= GRB.CONTINUOUS, lb = -GRB.INFINITY, ub = GRB.INFINITY, name = "e")  # Filter output (error)
+
+                # Parametrised constraints; the initial state and the reference
+                # only enter the right-hand sides, which are updated per sample
+                init_constr = m.addConstr(x[0:x_dim,:] == init_state)
+                state_constr = []
+                err_constr = []
+                for i in range(N_PRED):
+                    k = x_dim * i
+                    st = x[k:k+x_dim]
+
+                    # Output: e_i = C x_i + D (u_i - X[j+i])
+                    err_constr.append(m.addConstr(e[i] - self.C @ st - self.D * u[i] == 0))
+
+                    # Dynamics: x_(i+1) = A x_i + B (u_i - X[j+i])
+                    st_next = x[k+x_dim:k+2*x_dim]
+                    state_constr.append(m.addConstr(st_next - self.A @ st - self.B * u[i] == 0))
+
+                # Objective function
+                Obj = e @ e
+
+                # Set Gurobi objective
+                m.setObjective(Obj, GRB.MINIMIZE)
+
+                # MPC loop
+                for j in tqdm.tqdm(range(len_MPC)):
+                    t_step = time.perf_counter()
+
+                    # Update the parameters
+                    init_constr.RHS = init_state
+                    for i in range(N_PRED):
+                        err_constr[i].RHS = -self.D.reshape(-1) * X[j+i]
+                        state_constr[i].RHS = -self.B * X[j+i]
+
+                    # Optimization 
+                    t_start = time.perf_counter()
+                    m.optimize()
+                    t_solve = time.perf_counter() - t_start
+
+                    # Round off to nearest integers (u.X is only within m.Params.IntFeasTol of them)
+                    C_MPC = np.rint(u.X).astype(int)
+                    C[j] = C_MPC[0]
+
+                    # Saturation flag, from the free response over the horizon
+                    r = (Phi @ init_state).squeeze(axis=1) - Gamma @ X[j:j+N_PRED]
+                    sat = saturation_limited(r, Gamma, C_MPC, 0, 2**self.Nb-1)
+
+                    # Warm start: shift the solution by one sample
+                    u_start = np.append(C_MPC[1:], C_MPC[-1])
+                    u.Start = u_start
+
+                    # State prediction 
+                    con = QLS[C_MPC[0]] - X[j]
+                    x0_new = self.state_prediction(init_state, con)
+
+                    # State update for subsequent prediction horizon 
+                    init_state = x0_new
+
+                    # Per-step record (see lin_method_util.mhoq_stats_dtype)
+                    t_build = t_start - t_step
+                    t_step = time.perf_counter() - t_step
+                    self.stats[j] = (t_build, t_solve, t_step, int(m.NodeCount), m.MIPGap, sat, False)
+
+        return C.reshape(1,-1)
+
+    def get_codes_condensed(self, N_PRED, Xcs, YQns, MLns):
+        """
+        Same problem as get_codes, condensed with the lifted prediction matrices.
+        The state is eliminated, so each sample is a dense quadratic in the codes only:
+        ||r + Gamma @ u||^2 with r = Phi @ x0 - Gamma @ X[j:j+N_PRED].
+        The model is built once per run, and only the linear part of the objective
+        is updated per sample.
+        """
+
+        # Scale the input to the quantizer levels to run it as an MILP
+        X = self.q_scaling(Xcs)
+
+        QLS = self.scaled_levels(YQns, MLns)
+
+        # Loop length
+        len_MPC = X.size - N_PRED
+
+        # Storage container for code, and per-step record (timing and solver statistics)
+        C = np.zeros(len_MPC).astype(int)
+        self.stats = mhoq_stats(len_MPC)
+
+        # Lifted prediction matrices and the fixed quadratic part of the cost
+        Phi, Gamma = self.prediction_matrices(N_PRED)
+        H = Gamma.T @ Gamma
+
+        # State dimension
+        x_dim =  int(self.A.shape[0]) 
+
+        # Initial state
+        init_state = np.zeros(x_dim).reshape(-1,1)
+
+        with gp.Env(empty=True) as env:
+            env.setParam("OutputFlag",0)
+            env.start()
+            with gp.Model("MPC- INL", env = env) as m:
+                u = m.addMVar(N_PRED, vtype=GRB.INTEGER, name= "u", lb = 0, ub =  2**self.Nb-1) # control variable
+                uHu = u @ H @ u
+
+                # MPC loop
+                for j in tqdm.tqdm(range(len_MPC)):
+                    t_step = time.perf_counter()
+
+                    # Free response over the horizon
+                    r = (Phi @ init_state).squeeze(axis=1) - Gamma @ X[j:j+N_PRED]
+
+                    # Set Gurobi objective
+                    m.setObjective(uHu + 2*(Gamma.T @ r) @ u + r @ r, GRB.MINIMIZE)
+
+                    # Optimization 
+                    t_start = time.perf_counter()
+                    m.optimize()
+                    t_solve = time.perf_counter() - t_start
+
+                    # Round off to nearest integers (u.X is only within m.Params.IntFeasTol of them)
+                    C_MPC = np.rint(u.X).astype(int)
+                    C[j] = C_MPC[0]
+
+                    # Warm start: shift the solution by one sample
+                    u.Start = np.append(C_MPC[1:], C_MPC[-1])
+
+                    # State prediction 
+                    con = QLS[C_MPC[0]] - X[j]
+                    init_state = self.state_prediction(init_state, con)
+
+                    # Per-step record (see lin_method_util.mhoq_stats_dtype)
+                    sat = saturation_limited(r, Gamma, C_MPC, 0, 2**self.Nb-1)
+                    t_build = t_start - t_step
+                    t_step = time.perf_counter() - t_step
+                    self.stats[j] = (t_build, t_solve, t_step, int(m.NodeCount), m.MIPGap, sat, False)
+
+        return C.reshape(1,-1)
+
+    def get_codes_relaxed(self, N_PRED, Xcs, YQns, MLns, REFINE_K=0):
+        """
+        Approximate MHOQ for large level sets (e.g. 16 bit), where the MIQP is intractable.
+        The condensed cost ||r + Gamma @ v||^2 is minimised over continuous levels v in
+        closed form; Gamma is lower triangular (D != 0), so the relaxed optimum is found
+        by forward substitution, rounding each v_i to the nearest level before solving
+        for the next. The levels are the model levels QL (measured levels with QMODEL 2),
+        used both in the cost and in the state update.
+        With REFINE_K > 0 the (2*REFINE_K+1)^N_PRED neighbouring sequences, in sorted
+        level order, are evaluated in bulk and the cheapest is kept.
+        For N_PRED = 1 the rounded solution is exact.
+        """
+
+        match self.QMODEL:
+            case 1:
+                QL = YQns.squeeze()
+            case 2:
+                QL = MLns.squeeze()
+
+        # Scale the input and the levels to the code range
+        X = self.q_scaling(Xcs)
+        QLS = self.q_scaling(QL)
+
+        # Sort the levels once; searches are done in sorted order and mapped back to codes
+        LI = level_index(QLS)
+        QLS_sorted = LI.sorted
+        N_LEVELS = LI.size
+
+        # Lifted prediction matrices
+        Phi, Gamma = self.prediction_matrices(N_PRED)
+        Gd = np.diag(Gamma)
+
+        # Neighbourhood searched around the rounded sequence
+        if REFINE_K > 0:
+            OFFSETS = np.array(list(itertools.product(range(-REFINE_K, REFINE_K+1), repeat=N_PRED)))
+
+        # Loop length
+        len_MPC = X.size - N_PRED
+
+        # Storage container for code, and per-step record (timing and statistics)
+        C = np.zeros(len_MPC).astype(int)
+        self.stats = mhoq_stats(len_MPC)
+
+        # Candidates evaluated per step
+        N_CAND = OFFSETS.shape[0] if REFINE_K > 0 else 1
+
+        # State dimension
+        x_dim =  int(self.A.shape[0]) 
+
+        # Initial state
+        init_state = np.zeros(x_dim).reshape(-1,1)
+
+        # Rounded sequence (indices into the sorted levels)
+        idx = np.zeros(N_PRED).astype(int)
+
+        # MPC loop
+        for j in tqdm.tqdm(range(len_MPC)):
+            t_step = time.perf_counter()
+
+            # Free response over the horizon
+            r = (Phi @ init_state).squeeze(axis=1) - Gamma @ X[j:j+N_PRED]
+
+            # Relaxed solution by forward substitution, rounded to the nearest level
+            t_start = time.perf_counter()
+            e = r.copy()
+            for i in range(N_PRED):
+                idx[i] = LI.nearest_sorted(-e[i]/Gd[i])
+                e = e + Gamma[:,i]*QLS_sorted[idx[i]]
+
+            # Local refinement
+            if REFINE_K > 0:
+                IDX = np.clip(idx + OFFSETS, 0, N_LEVELS-1)
+                J = horizon_cost(r, Gamma, QLS_sorted[IDX])
+                idx = IDX[np.argmin(J)]
+            t_solve = time.perf_counter() - t_start
+
+            # Store only the first code
+            C[j] = LI.order[idx[0]]
+
+            # State prediction 
+            con = QLS[C[j]] - X[j]
+            init_state = self.state_prediction(init_state, con)
+
+            # Per-step record (see lin_method_util.mhoq_stats_dtype); no model and no optimality gap
+            sat = saturation_limited(r, Gamma, QLS_sorted[idx], QLS_sorted[0], QLS_sorted[-1])
+            t_step = time.perf_counter() - t_step
+            self.stats[j] = (0.0, t_solve, t_step, N_CAND, np.nan, sat, False)
+
+        return C.reshape(1,-1)
 
 
 # class MPC_BIN:
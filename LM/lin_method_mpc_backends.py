@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Solver backends for the moving horizon optimal quantiser (MHOQ/MPC).
+
+Each backend solves the horizon problem for one sample,
+
+    minimise ||r + Gamma @ QC[c]||^2 over the code sequence c,
+
+where r = Phi @ x0 - Gamma @ Xcs[j:j+N_PRED] is the free response of the
+reconstruction filter (see lin_method_util.prediction_matrices) and QC are the
+levels used in the cost function. The receding horizon loop itself is in
+MPC_BIN.get_codes(), and a backend is selected by name from mhoq_backends.
+
+Commercial and third-party solvers are optional; a backend raises ImportError
+when constructed if its solver is not installed.
+
+@author: Arnfinn Eielsen, Bikash Adhikari
+@date: 18.10.2026
+@license: BSD 3-Clause
+"""
+
+import numpy as np
+import time
+import os
+import sys
+import contextlib
+
+from LM.lin_method_util import horizon_cost
+from utils.quantiser_configurations import level_index
+
+try:
+    import gurobipy as gp
+    from gurobipy import GRB
+except ImportError:
+    gp = None
+
+try:
+    from scipy.optimize import milp, LinearConstraint, Bounds
+    from scipy.sparse import csr_array
+except ImportError:
+    milp = None
+
+try:
+    from ortools.sat.python import cp_model
+except ImportError:
+    cp_model = None
+
+
+class mhoq_backend:
+    """
+    Base class for the backends. A backend implements
+
+        solve(init_state, Xw, r) - solve the horizon problem for one sample, given the filter
+            state at the start of the horizon, the reference window and the free response over
+            the horizon; returns the optimal code sequence over the horizon, and sets nodes,
+            build_time and mip_gap for the per-step record
+
+    and may override warm_start and close.
+    :param mpc: The MHOQ object (filter, quantiser parameters and prediction matrices)
+    :param N_PRED: Prediction horizon | int
+    :param YQns: Levels used in the cost function
+    """
+    def __init__(self, mpc, N_PRED, YQns):
+        self.mpc = mpc
+        self.N_PRED = N_PRED
+        self.YQns = YQns
+        self.QC = YQns.squeeze()
+        self.LI = level_index(self.QC)  # levels in the cost function, sorted once
+        self.Phi, self.Gamma = mpc.prediction_matrices(N_PRED)
+        self.nodes = 0  # nodes visited in the last solve
+        self.build_time = 0.0  # model construction/update time in the last solve (seconds)
+        self.mip_gap = 0.0  # relative optimality gap of the last solve (0 for exact search)
+        self.fallback = False  # the last solve failed or hit a time limit, and returned the incumbent
+
+    def warm_start(self, seq):
+        """
+        Set the previous solution, when resuming a run, as if solve() had returned seq.
+        :param seq: Code sequence over the horizon
+        """
+        pass
+
+    def close(self):
+        """
+        Release solver resources at the end of a run.
+        """
+        pass
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    """
+    Discard the output of native code on the process stdout (file descriptor 1), e.g.
+    solver messages printed regardless of the solver log options.
+    """
+    sys.stdout.flush()
+    fd = os.dup(1)
+    try:
+        with open(os.devnull, 'w') as null:
+            os.dup2(null.fileno(), 1)
+        yield
+    finally:
+        os.dup2(fd, 1)
+        os.close(fd)
+
+
+def greedy_horizon(r, Gamma, LI):
+    """
+    Sequentially rounded code sequence (positions in the sorted levels of the level_index LI).
+    """
+    N_PRED = r.size
+    seq = np.zeros(N_PRED).astype(int)
+    res = r.copy()
+    for i in range(N_PRED):
+        seq[i] = LI.nearest_sorted(-res[i]/Gamma[i, i])
+        res = res + Gamma[:, i]*LI.sorted[seq[i]]
+    return seq
+
+
+class gurobi_backend(mhoq_backend):
+    """
+    MIQP with binary level selection and explicit state variables, built and solved
+    with Gurobi for every sample.
+    """
+    def __init__(self, mpc, N_PRED, YQns):
+        if gp is None:
+            raise ImportError('The gurobi backend requires gurobipy.')
+        super().__init__(mpc, N_PRED, YQns)
+
+    def solve(self, init_state, Xw, r):
+        N_PRED = self.N_PRED
+        YQns = self.YQns
+        A, B, C, D = self.mpc.A, self.mpc.B, self.mpc.C, self.mpc.D
+
+        # State dimension
+        x_dim =  int(A.shape[0])
+
+        t_start = time.perf_counter()
+        with gp.Env(empty=True) as env:
+            env.setParam("OutputFlag",0)
+            env.start()
+            with gp.Model("MPC- INL", env = env) as m:
+                u = m.addMVar((2**self.mpc.Nb, N_PRED), vtype=GRB.BINARY, name= "u") # control variable
+                x = m.addMVar((x_dim*(N_PRED+1),1), vtype= GRB.CONTINUOUS, lb = -GRB.INFINITY, ub = GRB.INFINITY, name = "x")  # State varible
+
+                # Add objective function
+                Obj = 0
+
+                # Set initial constraint
+                m.addConstr(x[0:x_dim,:] == init_state)
+                for i in range(N_PRED):
+                    k = x_dim * i
+                    st = x[k:k+x_dim]
+                    bin_con =  YQns.reshape(1,-1) @ u[:,i].reshape(-1,1)
+                    con = bin_con - Xw[i]
+
+                    # Objective update
+                    e_t = C @ x[k:k+x_dim] + D * con
+                    Obj = Obj + e_t * e_t
+
+                    # Constraints update
+                    f_value = A @ st + B * con
+                    st_next = x[k+x_dim:k+2*x_dim]
+                    m.addConstr(st_next == f_value)
+
+                    # Binary varialble constraint
+                    consi = gp.quicksum(u[:,i])
+                    m.addConstr(consi == 1)
+
+                # Set Gurobi objective
+                m.setObjective(Obj, GRB.MINIMIZE)
+
+                # Gurobi setting for precision
+                m.Params.IntFeasTol = 1e-9
+                m.Params.IntegralityFocus = 1
+
+                # Optimization
+                self.build_time = time.perf_counter() - t_start
+                m.optimize()
+
+                # Extract Code
+                u_val = u.X
+                self.nodes = int(m.NodeCount)
+                self.mip_gap = m.MIPGap
+
+        C_MPC = []
+        for i in range(N_PRED):
+            c1 = np.nonzero(u_val[:,i])[0][0]
+            C_MPC.append(int(c1))
+
+        return np.array(C_MPC)
+
+
+class gurobi_persistent_backend(mhoq_backend):
+    """
+    Same MIQP as the gurobi backend, but the environment and model are built once per run.
+    The filter output is an explicit variable, so the initial state and the reference
+    window only enter right-hand sides, which are updated per sample. Each solve is
+    warm-started from the previous solution shifted by one sample.
+    """
+    def __init__(self, mpc, N_PRED, YQns):
+        if gp is None:
+            raise ImportError('The gurobi_persistent backend requires gurobipy.')
+        super().__init__(mpc, N_PRED, YQns)
+
+        A, B, C, D = mpc.A, mpc.B, mpc.C, mpc.D
+
+        # State dimension
+        x_dim =  int(A.shape[0])
+
+        self.env = gp.Env(empty=True)
+        self.env.setParam("OutputFlag",0)
+        self.env.start()
+        m = gp.Model("MPC- INL", env = self.env)
+        u = m.addMVar((2**mpc.Nb, N_PRED), vtype=GRB.BINARY, name= "u") # control variable
+        x = m.addMVar((x_dim*(N_PRED+1),1), vtype= GRB.CONTINUOUS, lb = -GRB.INFINITY, ub = GRB.INFINITY, name = "x")  # State varible
+        e = m.addMVar(N_PRED, vtype= GRB.CONTINUOUS, lb = -GRB.INFINITY, ub = GRB.INFINITY, name = "e")  # Filter output (error)
+
+        # Parametrised constraints; the initial state and the reference
+        # only enter the right-hand sides, which are updated per sample
+        self.init_constr = m.addConstr(x[0:x_dim,:] == np.zeros((x_dim, 1)))
+        self.state_constr = []
+        self.err_constr = []
+        for i in range(N_PRED):
+            k = x_dim * i
+            st = x[k:k+x_dim]
+            bin_con =  YQns.reshape(1,-1) @ u[:,i].reshape(-1,1)
+
+            # Output: e_i = C x_i + D (bin_con - Xcs[j+i])
+            self.err_constr.append(m.addConstr(e[i] - C @ st - D * bin_con == 0))
+
+            # Dynamics: x_(i+1) = A x_i + B (bin_con - Xcs[j+i])
+            st_next = x[k+x_dim:k+2*x_dim]
+            self.state_constr.append(m.addConstr(st_next - A @ st - B * bin_con == 0))
+
+            # Binary varialble constraint
+            consi = gp.quicksum(u[:,i])
+            m.addConstr(consi == 1)
+
+        # Set Gurobi objective
+        m.setObjective(e @ e, GRB.MINIMIZE)
+
+        # Gurobi setting for precision
+        m.Params.IntFeasTol = 1e-9
+        m.Params.IntegralityFocus = 1
+
+        # The filter output is a constrained variable; tighten feasibility so
+        # that it resolves the (very small) cost differences between levels
+        m.Params.FeasibilityTol = 1e-9
+
+        self.m = m
+        self.u = u
+
+    def solve(self, init_state, Xw, r):
+        B, D = self.mpc.B, self.mpc.D
+
+        # Update the parameters
+        t_start = time.perf_counter()
+        self.init_constr.RHS = init_state
+        for i in range(self.N_PRED):
+            self.err_constr[i].RHS = -D.reshape(-1) * Xw[i]
+            self.state_constr[i].RHS = -B * Xw[i]
+        self.build_time = time.perf_counter() - t_start
+
+        # Optimization
+        self.m.optimize()
+        self.nodes = int(self.m.NodeCount)
+        self.mip_gap = self.m.MIPGap
+
+        # Extract code
+        u_val = self.u.X
+        seq = np.argmax(u_val, 0)
+
+        # Warm start: shift the solution by one sample
+        u_start = np.round(u_val)
+        u_start[:, 0:self.N_PRED-1] = u_start[:, 1:self.N_PRED]
+        self.u.Start = u_start
+
+        return seq
+
+    def warm_start(self, seq):
+        u_start = np.zeros(self.u.shape)
+        u_start[seq, np.arange(self.N_PRED)] = 1
+        u_start[:, 0:self.N_PRED-1] = u_start[:, 1:self.N_PRED]
+        self.u.Start = u_start
+
+    def close(self):
+        self.m.dispose()
+        self.env.dispose()
+
+
+class gurobi_condensed_backend(mhoq_backend):
+    """
+    The problem condensed with the lifted prediction matrices, so each sample is a dense
+    quadratic in the binaries only: ||r + Gamma @ V||^2 with V = YQns @ u. The model is
+    built once per run, and only the linear part of the objective is updated per sample.
+    """
+    def __init__(self, mpc, N_PRED, YQns):
+        if gp is None:
+            raise ImportError('The gurobi_condensed backend requires gurobipy.')
+        super().__init__(mpc, N_PRED, YQns)
+
+        # Fixed quadratic part of the cost
+        H = self.Gamma.T @ self.Gamma
+
+        self.env = gp.Env(empty=True)
+        self.env.setParam("OutputFlag",0)
+        self.env.start()
+        m = gp.Model("MPC- INL", env = self.env)
+        u = m.addMVar((2**mpc.Nb, N_PRED), vtype=GRB.BINARY, name= "u") # control variable
+
+        # Binary varialble constraint
+        m.addConstr(u.sum(axis=0) == 1)
+
+        # Levels over the horizon and the quadratic part of the cost,
+        # in LSB units to keep the cost coefficients well scaled
+        self.V = (self.QC/mpc.Qstep) @ u
+        self.VHV = self.V @ H @ self.V
+
+        # Gurobi setting for precision
+        m.Params.IntFeasTol = 1e-9
+        m.Params.IntegralityFocus = 1
+
+        self.m = m
+        self.u = u
+
+    def solve(self, init_state, Xw, r):
+        r = r/self.mpc.Qstep
+
+        # Set Gurobi objective
+        t_start = time.perf_counter()
+        self.m.setObjective(self.VHV + 2*(self.Gamma.T @ r) @ self.V + r @ r, GRB.MINIMIZE)
+        self.build_time = time.perf_counter() - t_start
+
+        # Optimization
+        self.m.optimize()
+        self.nodes = int(self.m.NodeCount)
+        self.mip_gap = self.m.MIPGap
+
+        # Extract code
+        u_val = self.u.X
+        seq = np.argmax(u_val, 0)
+
+        # Warm start: shift the solution by one sample
+        u_start = np.round(u_val)
+        u_start[:, 0:self.N_PRED-1] = u_start[:, 1:self.N_PRED]
+        self.u.Start = u_start
+
+        return seq
+
+    def warm_start(self, seq):
+        u_start = np.zeros(self.u.shape)
+        u_start[seq, np.arange(self.N_PRED)] = 1
+        u_start[:, 0:self.N_PRED-1] = u_start[:, 1:self.N_PRED]
+        self.u.Start = u_start
+
+    def close(self):
+        self.m.dispose()
+        self.env.dispose()
+
+
+class enum_backend(mhoq_backend):
+    """
+    Exact solution without a solver. For N_PRED = 1 the optimum is the level nearest
+    the unconstrained minimiser of a scalar quadratic, found by bisection. Longer horizons are solved by breadth-first enumeration of the
+    code sequences, pruning partial sequences whose cost exceeds that of the greedy
+    (sequentially rounded) sequence. The cost terms are squares, so partial costs never
+    decrease and the optimum is never pruned.
+
+    The result is the exact optimum (cost <= that of the MIQP backends, which stop within
+    the MIP tolerances), so compare the horizon costs with them, not the codes.
+    """
+    def solve(self, init_state, Xw, r):
+        Gamma = self.Gamma
+        QC = self.QC
+
+        if self.N_PRED == 1:
+            self.nodes = 1
+            return np.array([self.LI.nearest(-r[0]/Gamma[0, 0])])
+
+        N_PRED = self.N_PRED
+
+        # Greedy sequence as the incumbent (upper bound on the optimal cost),
+        # accumulated in the same order as the enumeration below
+        res = r.copy()
+        J_ub = 0.0
+        for i in range(N_PRED):
+            e_i = res[i] + Gamma[i, i]*QC
+            c = np.argmin(np.abs(e_i))
+            J_ub = J_ub + e_i[c]**2
+            res = res + Gamma[:, i]*QC[c]
+        J_ub = J_ub + 1e-12*abs(J_ub)  # round-off margin
+
+        # Partial sequences: codes, accumulated residual and cost
+        P = np.zeros((1, 0)).astype(int)
+        R = r.reshape(1, -1)
+        J = np.zeros(1)
+
+        self.nodes = 0
+        for i in range(N_PRED):
+            e_i = R[:, i].reshape(-1, 1) + Gamma[i, i]*QC.reshape(1, -1)
+            J_new = J.reshape(-1, 1) + e_i**2
+            self.nodes = self.nodes + J_new.size
+
+            # Prune partial sequences that cannot beat the incumbent
+            p, c = np.nonzero(J_new <= J_ub)
+
+            P = np.hstack((P[p, :], c.reshape(-1, 1)))
+            R = R[p, :] + Gamma[:, i].reshape(1, -1)*QC[c].reshape(-1, 1)
+            J = J_new[p, c]
+
+        return P[np.argmin(J), :]
+
+
+class sphere_backend(mhoq_backend):
+    """
+    Exact solution using a sphere decoder. The horizon cost is searched depth-first over
+    the code sequence, visiting the levels in order of increasing cost (Schnorr-Euchner).
+    The previous solution shifted by one sample is the initial incumbent (radius).
+    """
+    def __init__(self, mpc, N_PRED, YQns):
+        super().__init__(mpc, N_PRED, YQns)
+
+        # Levels in the cost function, sorted once
+        self.order = self.LI.order
+        self.QCs = self.LI.sorted
+
+        # Sorted level indices of the previous solution
+        self.seq = None
+
+    def solve(self, init_state, Xw, r):
+        Gamma = self.Gamma
+        QCs = self.QCs
+
+        # Incumbent: shifted previous solution, last step by nearest level
+        if self.seq is None:
+            seq_ws = greedy_horizon(r, Gamma, self.LI)
+        else:
+            seq_ws = self.seq.copy()
+            seq_ws[:-1] = self.seq[1:]
+            res = r + Gamma[:, :-1] @ QCs[seq_ws[:-1]]
+            seq_ws[-1] = self.LI.nearest_sorted(-res[-1]/Gamma[-1, -1])
+
+        self.seq, self.nodes = self.sphere_search(r, seq_ws)
+
+        return self.order[self.seq]
+
+    def warm_start(self, seq):
+        self.seq = self.LI.rank[seq]
+
+    def sphere_search(self, r, seq):
+        """
+        Depth-first search for the minimiser of ||r + Gamma @ QCs[seq]||^2,
+        starting with the incumbent seq. Returns the optimal sequence and the node count.
+        """
+        Gamma = self.Gamma
+        QCs = self.QCs
+        N_PRED = r.size
+        L = QCs.size
+
+        J_best = horizon_cost(r, Gamma, QCs[seq].reshape(1, -1))[0]
+        best = seq.copy()
+        cur = np.zeros(N_PRED).astype(int)
+        nodes = 0
+
+        def search(i, res, J):
+            nonlocal J_best, nodes
+            g = Gamma[i, i]
+            target = -res[i]/g
+
+            # Visit levels outwards from the target, i.e. with non-decreasing cost
+            hi = int(np.searchsorted(QCs, target))
+            lo = hi - 1
+            while lo >= 0 or hi < L:
+                if hi >= L or (lo >= 0 and target - QCs[lo] <= QCs[hi] - target):
+                    c = lo
+                    lo = lo - 1
+                else:
+                    c = hi
+                    hi = hi + 1
+
+                nodes += 1
+                e = res[i] + g*QCs[c]
+                J_c = J + e*e
+                if J_c >= J_best:  # remaining levels on this branch are worse
+                    break
+
+                cur[i] = c
+                if i == N_PRED - 1:
+                    J_best = J_c
+                    best[:] = cur
+                else:
+                    search(i + 1, res + Gamma[:, i]*QCs[c], J_c)
+
+        search(0, r, 0.0)
+
+        return best, nodes
+
+
+class highs_backend(mhoq_backend):
+    """
+    HiGHS MILP via scipy.optimize.milp, with the level of each step chosen by its code.
+    The problem is posed in LSB units to keep the coefficients well scaled.
+
+    Levels: a sequence that beats the greedy incumbent (cost J) has its unconstrained
+    minimiser v* = -Gamma^-1 r within sqrt(J) ||row i of Gamma^-1|| of each level v_i, so
+    only the levels in these windows are modelled (a few, also for 16 bit DACs). The position
+    in the window of step i is an integer with the binary expansion sum_b 2^b z_ib, and the
+    level is selected from it by the logarithmic SOS1 encoding (Vielma & Nemhauser),
+
+        sum_k lambda_ik = 1,  sum_{k: bit b of k} lambda_ik <= z_ib,
+        sum_{k: not bit b of k} lambda_ik <= 1 - z_ib,  v_i = sum_k lambda_ik QC_k,
+
+    i.e. log2 of the window size binaries per step instead of one per level.
+    Cost: each squared output e_i^2 is bounded below by tangent cuts t_i >= 2 p e_i - p^2,
+    and cuts at the latest solution are added until the lower bound meets the best true cost.
+
+    The MILPs of one sample are limited to TIME_LIMIT seconds in total. If HiGHS fails or
+    stops without a proven optimum, the best sequence found so far (at least the greedy one)
+    is returned, and the step is recorded as a fallback (with an unknown gap if a MILP failed).
+    """
+    TIME_LIMIT = 10.0
+
+    def __init__(self, mpc, N_PRED, YQns):
+        if milp is None:
+            raise ImportError('The highs backend requires scipy >= 1.9 (scipy.optimize.milp).')
+        super().__init__(mpc, N_PRED, YQns)
+
+        self.QCn = self.QC/mpc.Qstep
+        self.LIn = level_index(self.QCn)
+        self.order = self.LIn.order
+        self.QCs = self.LIn.sorted
+
+        # Unconstrained minimiser, and the half-width of the level windows per unit sqrt(cost)
+        self.Gamma_inv = np.linalg.inv(self.Gamma)
+        self.w = np.sqrt(np.sum(self.Gamma_inv**2, 1))
+
+    def model(self, r, J, cuts):
+        """
+        MILP of the horizon problem restricted to the sequences with cost <= J.
+        Returns the milp arguments, the window start (sorted position) and the columns of the
+        code bits of each step, and the column of e.
+        """
+        N_PRED = self.N_PRED
+        v = -self.Gamma_inv @ r
+        lo, hi = self.LIn.within(v, np.sqrt(J)*self.w)
+
+        # Columns: per step the code bits z and the window weights lambda, then e and t
+        cols_z, cols_l = [], []
+        n = 0
+        for i in range(N_PRED):
+            K = hi[i] - lo[i]
+            nb = int(np.ceil(np.log2(K))) if K > 1 else 0
+            cols_z.append(np.arange(n, n + nb))
+            cols_l.append(np.arange(n + nb, n + nb + K))
+            n = n + nb + K
+        i_e = n
+        n_var = n + 2*N_PRED
+
+        c_obj = np.zeros(n_var)
+        c_obj[i_e + N_PRED:] = 1.0
+        integrality = np.zeros(n_var)
+        lb = np.zeros(n_var)
+        ub = np.ones(n_var)
+        lb[i_e:i_e + N_PRED] = -np.inf
+        ub[i_e:] = np.inf
+        for i in range(N_PRED):
+            integrality[cols_z[i]] = 1
+
+        rows, cols, vals, b_lo, b_hi = [], [], [], [], []
+
+        def add_row(c, a, l, u):
+            rows.extend([len(b_lo)]*len(c))
+            cols.extend(c)
+            vals.extend(a)
+            b_lo.append(l)
+            b_hi.append(u)
+
+        for i in range(N_PRED):
+            K = cols_l[i].size
+            add_row(cols_l[i], np.ones(K), 1, 1)  # one level per step
+            k = np.arange(K)
+            for b, z in enumerate(cols_z[i]):
+                bit = (k >> b) & 1 == 1
+                add_row(np.append(cols_l[i][bit], z), np.append(np.ones(np.sum(bit)), -1), -np.inf, 0)
+                add_row(np.append(cols_l[i][~bit], z), np.append(np.ones(np.sum(~bit)), 1), -np.inf, 1)
+
+        # Output: e - Gamma @ V = r
+        for i in range(N_PRED):
+            c_i, a_i = [i_e + i], [1.0]
+            for k in range(i + 1):
+                c_i.extend(cols_l[k])
+                a_i.extend(-self.Gamma[i, k]*self.QCs[lo[k]:hi[k]])
+            add_row(c_i, a_i, r[i], r[i])
+
+        # Tangent cuts, once per point
+        for i in range(N_PRED):
+            for p in np.unique(np.array(cuts)[:, i]):
+                add_row([i_e + i, i_e + N_PRED + i], [-2*p, 1], -p**2, np.inf)
+
+        A = csr_array((vals, (rows, cols)), shape=(len(b_lo), n_var))
+        args = dict(c=c_obj, integrality=integrality, bounds=Bounds(lb, ub),
+                    constraints=LinearConstraint(A, b_lo, b_hi))
+
+        return args, lo, cols_z, i_e
+
+    def solve(self, init_state, Xw, r):
+        N_PRED = self.N_PRED
+        r = r/self.mpc.Qstep
+
+        # Greedy incumbent, and cuts at its outputs
+        seq_best = greedy_horizon(r, self.Gamma, self.LIn)
+        e = r + self.Gamma @ self.QCs[seq_best]
+        J_best = e @ e
+        J_window = J_best*(1 + 1e-9) + 1e-12  # round-off margin, the incumbent is in the windows
+        cuts = [e]
+
+        self.nodes = 0
+        self.build_time = 0.0
+        self.mip_gap = 0.0
+        self.fallback = False
+        t_limit = time.perf_counter() + self.TIME_LIMIT
+        for itr in range(100):
+            t_start = time.perf_counter()
+            args, lo, cols_z, i_e = self.model(r, J_window, cuts)
+            self.build_time = self.build_time + time.perf_counter() - t_start
+
+            options = {'mip_rel_gap': 0, 'disp': False, 'time_limit': max(t_limit - time.perf_counter(), 1e-3)}
+            with quiet_stdout():  # HiGHS prints some MIP messages even with disp off
+                res = milp(**args, options=options)
+                if res.status == 4:  # solve error, HiGHS presolve can fail on these small models
+                    res = milp(**args, options=dict(options, presolve=False))
+            self.nodes = self.nodes + int(getattr(res, 'mip_node_count', 0) or 0)
+
+            if res.x is not None:
+                seq = lo + np.array([np.rint(res.x[z]) @ 2**np.arange(z.size) for z in cols_z]).astype(int)
+                e = r + self.Gamma @ self.QCs[seq]
+                J = e @ e
+                if J < J_best:
+                    J_best = J
+                    seq_best = seq
+
+            # Solver error, or time limit within the MILP: keep the incumbent
+            if not res.success or res.x is None:
+                self.fallback = True
+                self.mip_gap = np.nan
+                break
+
+            # Lower bound from the outer approximation meets the incumbent
+            self.mip_gap = (J_best - res.fun)/max(J_best, np.finfo(float).tiny)
+            if J_best - res.fun <= 1e-9*max(1.0, J_best):
+                break
+
+            # Time limit between the MILPs: keep the incumbent (the gap is known)
+            if time.perf_counter() >= t_limit:
+                self.fallback = True
+                break
+            cuts.append(e)
+
+        return self.order[seq_best]
+
+
+class cpsat_backend(mhoq_backend):
+    """
+    OR-Tools CP-SAT. The outputs are scaled to integers (SCALE per LSB), so levels closer
+    than the scaling resolution may be resolved differently from the exact backends.
+    """
+    SCALE = 2**10
+
+    def __init__(self, mpc, N_PRED, YQns):
+        if cp_model is None:
+            raise ImportError('The cpsat backend requires ortools.')
+        super().__init__(mpc, N_PRED, YQns)
+
+        self.QCn = self.QC/mpc.Qstep
+        self.LIn = level_index(self.QCn)
+        self.order = self.LIn.order
+        self.QCs = self.LIn.sorted
+
+        # Integer coefficients of each level at each step on each output
+        self.coef = np.round(self.SCALE*self.Gamma.reshape(N_PRED, N_PRED, 1)*self.QCn.reshape(1, 1, -1)).astype(int)
+
+    def solve(self, init_state, Xw, r):
+        N_PRED = self.N_PRED
+        L = self.QC.size
+        r = r/self.mpc.Qstep
+        r_int = np.round(self.SCALE*r).astype(int)
+
+        t_start = time.perf_counter()
+        m = cp_model.CpModel()
+        u = [[m.NewBoolVar(f'u_{l}_{i}') for l in range(L)] for i in range(N_PRED)]
+        for i in range(N_PRED):
+            m.AddExactlyOne(u[i])
+
+        # Hint: greedy solution
+        seq_ws = self.order[greedy_horizon(r, self.Gamma, self.LIn)]
+        for i in range(N_PRED):
+            m.AddHint(u[i][seq_ws[i]], 1)
+
+        t = []
+        for i in range(N_PRED):
+            bound = int(abs(r_int[i]) + np.sum(np.max(np.abs(self.coef[i, 0:i+1, :]), 1)))
+            e_i = m.NewIntVar(-bound, bound, f'e_{i}')
+            m.Add(e_i == int(r_int[i]) + sum(int(self.coef[i, k, l])*u[k][l] for k in range(i+1) for l in range(L)))
+            t_i = m.NewIntVar(0, bound*bound, f't_{i}')
+            m.AddMultiplicationEquality(t_i, [e_i, e_i])
+            t.append(t_i)
+        m.Minimize(sum(t))
+        self.build_time = time.perf_counter() - t_start
+
+        solver = cp_model.CpSolver()
+        solver.parameters.num_workers = 1
+        solver.Solve(m)
+        self.nodes = int(solver.NumBranches())
+        J = solver.ObjectiveValue()
+        self.mip_gap = (J - solver.BestObjectiveBound())/max(J, 1)
+
+        seq = np.array([[solver.Value(u[i][l]) for l in range(L)] for i in range(N_PRED)])
+        return np.argmax(seq, 1)
+
+
+# Backends by name
+mhoq_backends = {
+    'gurobi': gurobi_backend,
+    'gurobi_persistent': gurobi_persistent_backend,
+    'gurobi_condensed': gurobi_condensed_backend,
+    'enum': enum_backend,
+    'sphere': sphere_backend,
+    'highs': highs_backend,
+    'cpsat': cpsat_backend,
+}
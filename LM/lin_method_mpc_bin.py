@@ -12,10 +12,15 @@ import numpy as np
 from scipy import linalg , signal
 import sys
 import random
-import gurobipy as gp
-from gurobipy import GRB
+import time
+import os
+import concurrent.futures
 import tqdm
 
+from LM.lin_method_util import prediction_matrices, mhoq_stats, saturation_limited
+from LM.lin_method_mpc_backends import mhoq_backends
+from utils.checkpoint import fingerprint
+
 
 class MPC_BIN:
     def __init__(self, Nb, Qstep, QMODEL,  A, B, C, D):
@@ -35,6 +40,9 @@ class MPC_BIN:
         self.B = B
         self.C = C
         self.D = D
+
+        # Lifted prediction matrices for each horizon used
+        self.pred_mats = {}
     
         
     def state_prediction(self, st, con):
@@ -44,9 +52,39 @@ class MPC_BIN:
         x_iplus1 = self.A @ st + self.B * con
         return x_iplus1
     
-    # def get_codes(self, Xcs, N_PRED, YQns, MLns)
-    def get_codes(self, N_PRED, Xcs, YQns, MLns ):
+    def prediction_matrices(self, N_PRED):
+        """
+        Lifted prediction matrices of the reconstruction filter over the horizon,
+        computed once per filter and horizon (see lin_method_util.prediction_matrices).
+        :param N_PRED: Prediction horizon | int
+        :return Phi: State-to-output matrix (N_PRED x x_dim)
+        :return Gamma: Input-to-output lower triangular Toeplitz matrix (N_PRED x N_PRED)
+        """
+        if N_PRED not in self.pred_mats:
+            self.pred_mats[N_PRED] = prediction_matrices(self.A, self.B, self.C, self.D, N_PRED)
+        return self.pred_mats[N_PRED]
 
+    # def get_codes(self, Xcs, N_PRED, YQns, MLns)
+    def get_codes(self, N_PRED, Xcs, YQns, MLns, SOLVER='gurobi', PROGRESS=True, CHECKPOINT=None):
+        """
+        Compute the codes using a moving horizon.
+        :param N_PRED: Prediction horizon | int
+        :param Xcs: Reference/Test signal
+        :param YQns: Ideal quantization levels
+        :param MLns: Measured quantization levels
+        :param SOLVER: Name of the backend solving each horizon problem (see lin_method_mpc_backends):
+                       'gurobi' - MIQP per sample,
+                       'gurobi_persistent' - one MIQP for the run, updated per sample,
+                       'gurobi_condensed' - MIQP in the codes only (no state variables),
+                       'highs' - MILP with outer approximation of the cost (SciPy),
+                       'cpsat' - integer-scaled problem (OR-Tools CP-SAT),
+                       'enum' - exact enumeration (no solver needed); the exact optimum of each horizon
+                                problem, with a cost <= that of the Gurobi backends (their MIP
+                                tolerances can return suboptimal codes, so the codes need not agree),
+                       'sphere' - sphere decoder (no solver needed, for longer horizons)
+        :param PROGRESS: Show a progress bar
+        :param CHECKPOINT: Periodically save the progress, and resume an interrupted run (see utils.checkpoint)
+        """
 
         match self.QMODEL:
             case 1:
@@ -54,109 +92,151 @@ class MPC_BIN:
             case 2:
                 QL = MLns.squeeze()
 
-        # Storage container for code
-        C = []
+        Xcs = Xcs.squeeze()
 
         # Loop length
         len_MPC = Xcs.size - N_PRED
 
+        # Storage container for code, and per-step record (timing and solver statistics)
+        C = np.zeros(len_MPC).astype(int)
+        self.stats = mhoq_stats(len_MPC)
+
+        # Lifted prediction matrices, computed once per filter and horizon
+        Phi, Gamma = self.prediction_matrices(N_PRED)
+
         # State dimension
         x_dim =  int(self.A.shape[0]) 
 
         # Initial state
         init_state = np.zeros(x_dim).reshape(-1,1)
 
-        
+        if SOLVER not in mhoq_backends:
+            raise ValueError(f'Unknown MHOQ solver: {SOLVER}')
+        backend = mhoq_backends[SOLVER](self, N_PRED, YQns)
+
+        # Extreme levels in the cost, for the saturation flag
+        QC_min = np.min(YQns)
+        QC_max = np.max(YQns)
+
+        # Resume an interrupted run
+        j_start = 0
+        if CHECKPOINT is not None:
+            fp = fingerprint(N_PRED, Xcs, YQns, MLns, SOLVER, self.QMODEL, self.A, self.B, self.C, self.D)
+            state = CHECKPOINT.load(fp)
+            if state is not None:
+                j_start = state['j']
+                C[0:j_start] = state['C']
+                self.stats[0:j_start] = state['stats']
+                init_state = state['init_state']
+                backend.warm_start(state['seq'])
+                print(f'Resuming from sample {j_start} of {len_MPC}')
 
         # MPC loop
-        for j in tqdm.tqdm(range(len_MPC)):
-            env = gp.Env(empty=True)
-            env.setParam("OutputFlag",0)
-            env.start()
-            m = gp.Model("MPC- INL", env = env)
-            u = m.addMVar((2**self.Nb, N_PRED), vtype=GRB.BINARY, name= "u") # control variable
-            x = m.addMVar((x_dim*(N_PRED+1),1), vtype= GRB.CONTINUOUS, lb = -GRB.INFINITY, ub = GRB.INFINITY, name = "x")  # State varible 
-
-
-            # Add objective function
-            Obj = 0
-
-            # Set initial constraint
-            m.addConstr(x[0:x_dim,:] == init_state)
-            for i in range(N_PRED):
-                k = x_dim * i
-                st = x[k:k+x_dim]
-                bin_con =  YQns.reshape(1,-1) @ u[:,i].reshape(-1,1) 
-                con = bin_con - Xcs[j+i]
-
-                # Objective update
-                e_t = self.C @ x[k:k+x_dim] + self.D * con
-                Obj = Obj + e_t * e_t
-
-                # Constraints update
-                f_value = self.A @ st + self.B * con
-                st_next = x[k+x_dim:k+2*x_dim]
-                m.addConstr(st_next == f_value)
-
-                # Binary varialble constraint
-                consi = gp.quicksum(u[:,i]) 
-                m.addConstr(consi == 1)
-        # m.addConstr(consi >= 0.98)
-        # m.addConstr(consi <= 1.02
-            # Gurobi model update
-            m.update
-
-            # Set Gurobi objective
-            m.setObjective(Obj, GRB.MINIMIZE)
-
-            # 0 - Supress log output, 1- Print log outputs
-            # m.Params.LogToConsole = 0
-
-            # Gurobi setting for precision  
-            m.Params.IntFeasTol = 1e-9
-            m.Params.IntegralityFocus = 1
-
-            # Optimization 
-            m.optimize()
-
-            # Extract variable values 
-            allvars = m.getVars()
-            values = m.getAttr("X",allvars)
-            values = np.array(values)
-
-            # Variable dimension
-            nr, nc = u.shape
-            u_val = values[0:nr*nc]
-            u_val = np.reshape(u_val, (2**self.Nb, N_PRED))
-
-            # Extract Code
-            C_MPC = []
-            for i in range(N_PRED):
-                c1 = np.nonzero(u_val[:,i])[0][0]
-                c1 = int(c1)
-                C_MPC.append(c1)
-            C_MPC = np.array(C_MPC)
-            C.append(C_MPC[0])
-
-            U_opt = QL[C_MPC[0]] 
-            # # Extract only the value of the variable "u", value of the variable "x" are not needed
-            # C_MPC = values[0:N_PRED]
-
-            # # Ideally they should be integral, but gurobi generally return them in floating point values according to the precision tolorence set: m.Params.IntFeasTol
-            # # Round off to nearest integers
-            # C_MPC = C_MPC.astype(int)
-
-            # # Store only the first value /code
-            # C.append(C_MPC[0])
-
-            # # Get DAC level according to the coe
-            # U_opt = QLS[C_MPC[0]] 
+        for j in tqdm.tqdm(range(j_start, len_MPC), initial=j_start, total=len_MPC, disable=not PROGRESS):
+            t_step = time.perf_counter()
+            Xw = Xcs[j:j+N_PRED]
+
+            # Free response over the horizon
+            r = (Phi @ init_state).squeeze(axis=1) - Gamma @ Xw
+
+            t_start = time.perf_counter()
+            C_MPC = backend.solve(init_state, Xw, r)
+            t_solve = time.perf_counter() - t_start
+
+            # Store only the first code
+            c = int(C_MPC[0])
+            C[j] = c
 
             # State prediction 
-            con = U_opt - Xcs[j]
+            con = QL[c] - Xcs[j]
             x0_new = self.state_prediction(init_state, con)
 
             # State update for subsequent prediction horizon 
             init_state = x0_new
 
-        return np.array(C).reshape(1,-1)
+            # Per-step record (see lin_method_util.mhoq_stats_dtype)
+            sat = saturation_limited(r, Gamma, backend.QC[C_MPC], QC_min, QC_max)
+            t_step = time.perf_counter() - t_step
+            self.stats[j] = (backend.build_time, t_solve - backend.build_time, t_step, backend.nodes, backend.mip_gap, sat, backend.fallback)
+
+            # Save the progress up to and including this sample
+            if CHECKPOINT is not None and CHECKPOINT.due():
+                CHECKPOINT.save(fp, j=j+1, C=C[0:j+1], stats=self.stats[0:j+1], init_state=init_state, seq=C_MPC)
+
+        backend.close()
+
+        if CHECKPOINT is not None:
+            CHECKPOINT.clear()
+
+        return C.reshape(1,-1)
+
+    def get_codes_parallel(self, N_PRED, Xcs, YQns, MLns, SOLVER='enum', N_SEG=None, WARMUP=2000, N_PROC=None):
+        """
+        Compute the codes with the reference split into segments solved on a process pool.
+        Each segment starts from a zero filter state WARMUP samples before its first kept
+        code, so that the state has converged when its codes are kept. Codes near the
+        seams may still differ from a serial run (see seam_differences).
+        :param N_PRED: Prediction horizon | int
+        :param Xcs: Reference/Test signal
+        :param YQns: Ideal quantization levels
+        :param MLns: Measured quantization levels
+        :param SOLVER: Name of the backend (see get_codes)
+        :param N_SEG: Number of segments, defaults to the number of processes
+        :param WARMUP: Overlap (in samples) discarded at the start of each segment
+        :param N_PROC: Number of processes, defaults to the number of CPUs
+        """
+
+        Xcs = Xcs.squeeze()
+
+        # Loop length
+        len_MPC = Xcs.size - N_PRED
+
+        if N_PROC is None:
+            N_PROC = os.cpu_count()
+        if N_SEG is None:
+            N_SEG = N_PROC
+
+        # First kept code of each segment
+        bounds = np.linspace(0, len_MPC, N_SEG+1).astype(int)
+        self.seams = bounds[1:-1]
+
+        # Segments including the warm-up overlap
+        jobs = []
+        for k in range(N_SEG):
+            a, b = bounds[k], bounds[k+1]
+            start = max(0, a - WARMUP)
+            jobs.append((self, N_PRED, Xcs[start:b+N_PRED], YQns, MLns, SOLVER, a - start))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=N_PROC) as executor:
+            results = list(tqdm.tqdm(executor.map(mhoq_segment, *zip(*jobs)), total=N_SEG))
+
+        C = np.concatenate([res[0] for res in results])
+        self.stats = np.concatenate([res[1] for res in results])
+
+        return C.reshape(1,-1)
+
+
+def mhoq_segment(mpc, N_PRED, Xseg, YQns, MLns, SOLVER, n_skip):
+    """
+    Solve one segment (in a worker process) and drop the warm-up codes.
+    """
+    C = mpc.get_codes(N_PRED, Xseg, YQns, MLns, SOLVER=SOLVER, PROGRESS=False)
+    return C[0, n_skip:], mpc.stats[n_skip:]
+
+
+def seam_differences(C, C_ref, seams, WINDOW=1000):
+    """
+    Count the codes that differ from a reference (serial) run after each seam.
+    :param C: Codes from get_codes_parallel
+    :param C_ref: Codes from get_codes
+    :param seams: First code of each segment after the first (MPC_BIN.seams)
+    :param WINDOW: Number of samples after each seam to compare
+    :return: Number of differing codes in the window after each seam, and in total
+    """
+    C = C.squeeze()
+    C_ref = C_ref.squeeze()
+    diff = C != C_ref
+
+    n_seam = np.array([np.sum(diff[s:s+WINDOW]) for s in seams]).astype(int)
+
+    return n_seam, int(np.sum(diff))
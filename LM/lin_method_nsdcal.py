@@ -10,9 +10,16 @@
 import numpy as np
 import math
 from scipy import signal
-from utils.balreal import balreal
+from utils.ns_filters import ns_filter, nsf
+from utils.quantiser_configurations import level_index
 
-def nsdcal(X, Dq, YQns, MLns, Qstep, Vmin, Nb, QMODEL):
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # fall back to the plain Python loop
+
+
+def nsdcal(X, Dq, YQns, MLns, Qstep, Vmin, Nb, QMODEL, COMPILED=True, FILTER=(2, nsf.integrator)):
     """
     X
         input signal
@@ -28,82 +35,306 @@ def nsdcal(X, Dq, YQns, MLns, Qstep, Vmin, Nb, QMODEL):
         choice of quantiser model
             1: ideal
             2: measured/calibrated
+            3: measured/calibrated, re-quantising to the nearest measured level
+    COMPILED
+        use the Numba-compiled loop if Numba is installed
+    FILTER
+        noise-shaping filter, (ORDER, DESIGN[, Wn]) for ns_filter; default double integrator
+    """
+    NS = nsdcal_stream(YQns, MLns, Qstep, Vmin, Nb, QMODEL, COMPILED, FILTER)
+    C = NS.process(X, Dq)
+
+    if NS.satcnt >= 10:
+        print(f'warning: saturation -- cnt: {NS.satcnt}')
+
+    return C
+
+
+class nsdcal_stream:
+    """
+    Stateful nsdcal for input given in chunks, e.g. arbitrarily long stimuli processed in
+    bounded memory. The noise-shaping filter state, its output and the saturation counter
+    are carried between calls, so the concatenated codes equal those of nsdcal for the
+    concatenated input.
+    :param YQns, MLns: Ideal and measured levels, 1d arrays
+    :param Qstep, Vmin, Nb: Quantiser params.
+    :param QMODEL: Choice of quantiser model (see nsdcal)
+    :param COMPILED: Use the Numba-compiled loop if Numba is installed
+    :param FILTER: Noise-shaping filter, (ORDER, DESIGN[, Wn]) for ns_filter
+    """
+    def __init__(self, YQns, MLns, Qstep, Vmin, Nb, QMODEL, COMPILED=True, FILTER=(2, nsf.integrator)):
+        self.YQns = np.ascontiguousarray(YQns, dtype=np.float64).reshape(-1)
+        self.MLns = np.ascontiguousarray(MLns, dtype=np.float64).reshape(-1)
+        self.Qstep = Qstep
+        self.Vmin = Vmin
+        self.Nb = Nb
+        self.QMODEL = QMODEL
+
+        Ad, Bd, Cd = ns_filter(*FILTER)  # precomputed balanced realisation
+        self.Ad, self.Bd, self.Cd = Ad, Bd.reshape(-1), Cd.reshape(-1)
+
+        if QMODEL == 3:
+            # Measured levels sorted once, for nearest-level search by bisection
+            LI = level_index(self.MLns)
+            self.Ls, self.Lo = LI.sorted, LI.order
+        else:
+            self.Ls, self.Lo = np.zeros(1), np.zeros(1, dtype=np.int64)  # unused
+
+        self.loop = nsdcal_kernel if COMPILED and njit is not None else nsdcal_loop
+
+        self.reset()
+
+    def reset(self):
+        """
+        Initialise state, output and saturation counter.
+        """
+        self.xns = np.zeros(self.Ad.shape[0])  # noise-shaping filter state
+        self.yns = 0.0  # noise-shaping filter output
+        self.satcnt = 0  # saturation counter
+
+    def process(self, X, Dq):
+        """
+        Codes for the next chunk of input.
+        :param X: Input signal chunk
+        :param Dq: Re-quantiser dither chunk (same length)
+        :return: Codes, (1, len(X)) array
+        """
+        X = np.ascontiguousarray(X, dtype=np.float64).reshape(-1)
+        Dq = np.ascontiguousarray(Dq, dtype=np.float64).reshape(-1)
+
+        C, satcnt, self.yns = self.loop(X, Dq, self.YQns, self.MLns, self.Ad, self.Bd, self.Cd,
+                                        self.Qstep, self.Vmin, self.Nb, self.QMODEL, self.Ls, self.Lo,
+                                        self.xns, self.yns)
+        self.satcnt = self.satcnt + satcnt
+
+        return C.reshape(1, -1)
+
+    def chunks(self, XD):
+        """
+        Generator over the codes of an iterable of (X, Dq) chunks.
+        """
+        for X, Dq in XD:
+            yield self.process(X, Dq)
+
+
+def nsdcal_loop(X, Dq, YQns, MLns, Ad, Bd, Cd, Qstep, Vmin, Nb, QMODEL, Ls, Lo, xns, yns):
     """
-    # Noise-shaping filter (using a simple double integrator)
-    # b = np.array([1, -2, 1])
-    # a = np.array([1, 0, 0])
-    # # Hns_tf = signal.TransferFunction(b, a, dt=1)  # double integrator
-    # Mns_tf = signal.TransferFunction(a-b, a, dt=1)  # Mns = 1 - Hns
-    # Mns = Mns_tf.to_ss()
-
-    match 1:
-        case 1:
-            AM = np.array([[0.0, 0.0], [1.0, 0.0]])
-            BM = np.array([[2.0], [0.0]])
-            CM = np.array([[1.0, -0.5]])
-            DM = np.array([[0.0]])
-        case 2:
-            AM = np.array([[0.3538, -0.3666, 0.0330], [1.0000,  0,  0], [ 0, 1.0000 , 0]])
-            BM = np.array([ [1], [0],[0]])
-            CM = np.array([-1.4063,    0.8164 ,  -0.2451])
-            DM = np.array([[0.0]])
-
-    # Make a balanced realisation.
-    # Less sensitivity to filter coefficients in the IIR implementation.
-    # (Useful if having to used fixed-point implementation and/or if the filter order is to be high.)
-    # Ad, Bd, Cd, Dd = balreal(Mns.A, Mns.B, Mns.C, Mns.D)
-    Ad, Bd, Cd, Dd = balreal(AM, BM, CM, DM)
-    # Initialise state, output and error
-    xns = np.zeros((Ad.shape[0], 1))  # noise-shaping filter state
-    yns = np.zeros((1, 1))  # noise-shaping filter output
-    e = np.zeros((1, 1))  # quantiser error
-
-    C = np.zeros((1, X.size)).astype(int)  # save codes
+    Noise-shaping loop on contiguous float64 buffers; compiled with Numba when available
+    (nsdcal_kernel), otherwise run as plain Python. The filter update uses the same matrix
+    products as the original loop (BLAS gemv/dot; Numba calls BLAS through SciPy), which
+    may contract to FMA. A one-ULP change of the state can flip a quantiser decision and
+    the trajectory from there on, so these products are kept for identical codes.
+
+    Arguments
+        X, Dq - input signal and re-quantiser dither, 1d arrays
+        YQns, MLns - ideal and measured levels, 1d arrays
+        Ad, Bd, Cd - noise-shaping filter (balanced realisation), Bd and Cd as 1d arrays
+        Qstep, Vmin, Nb, QMODEL - as for nsdcal
+        Ls, Lo - measured levels sorted, and the corresponding codes (QMODEL 3)
+        xns, yns - initial filter state (1d array, updated in place) and output
+
+    Returns
+        C - codes, 1d array
+        satcnt - number of saturated samples
+        yns - final filter output
+    """
+    L = Ls.size
+
+    e = 0.0  # quantiser error
+
+    C = np.zeros(X.size, dtype=np.int64)  # save codes
 
     satcnt = 0  # saturation counter (generate warning if saturating)
-    
+    c_max = 2**Nb - 1
+    c_off = math.floor(Vmin/Qstep)
+
+    u_min = Ls[0] - Qstep/2  # saturation limits (QMODEL 3)
+    u_max = Ls[L-1] + Qstep/2
+
     FB_ON = True  # turn on/off feedback, for testing
-    
+
     for i in range(0, X.size):
         x = X[i]  # noise-shaper input
         d = Dq[i]  # re-quantisation dither
-        
-        if FB_ON: w = x - yns[0, 0]  # use feedback
+
+        if FB_ON: w = x - yns  # use feedback
         else: w = x
-        
+
         u = w + d  # re-quantizer input
-        
-        # Re-quantizer (mid-tread)
-        q = math.floor(u/Qstep + 0.5)  # quantize
-        c = q - math.floor(Vmin/Qstep)  # code
-        C[0, i] = c  # save code
-
-        # Saturation (can't index out of bounds)
-        if c > 2**Nb - 1:
-            c = 2**Nb - 1
-            satcnt = satcnt + 1
-            if satcnt >= 10:
-                print(f'warning: pos. sat. -- cnt: {satcnt}')
-            
-        if c < 0:
-            c = 0
-            satcnt = satcnt + 1
-            if satcnt >= 10:
-                print(f'warning: neg. sat. -- cnt: {satcnt}')
-        
-        # Output models
-        yi = YQns[c]  # ideal levels
-        ym = MLns[c]  # measured levels
-        
-        # Generate error
-        match QMODEL:  # model used in feedback
-            case 1:  # ideal
-                e[0] = yi - w
-            case 2:  # measured/calibrated
-                e[0] = ym - w
-        
-        # Noise-shaping filter
-        xns = Ad@xns + Bd@e  # update state
-        yns = Cd@xns  # update filter output
-
-    return C
\ No newline at end of file
+
+        if QMODEL == 3:
+            # Re-quantizer (nearest measured level, ties to the lower level, see level_index)
+            lo, hi = 0, L  # bisection, first k with Ls[k] >= u
+            while lo < hi:
+                m = (lo + hi)//2
+                if Ls[m] < u: lo = m + 1
+                else: hi = m
+            k = lo
+            if k == L or (k > 0 and u - Ls[k-1] <= Ls[k] - u):
+                k = k - 1
+                while k > 0 and Ls[k-1] == Ls[k]: k = k - 1  # first of equal levels
+            c = Lo[k]  # code
+            C[i] = c  # save code
+
+            # Saturation (beyond the extreme levels)
+            if u > u_max or u < u_min:
+                satcnt = satcnt + 1
+        else:
+            # Re-quantizer (mid-tread)
+            q = math.floor(u/Qstep + 0.5)  # quantize
+            c = q - c_off  # code
+            C[i] = c  # save code
+
+            # Saturation (can't index out of bounds)
+            if c > c_max:
+                c = c_max
+                satcnt = satcnt + 1
+            if c < 0:
+                c = 0
+                satcnt = satcnt + 1
+
+        # Generate error, model used in feedback
+        if QMODEL == 1:
+            e = YQns[c] - w  # ideal levels
+        else:
+            e = MLns[c] - w  # measured/calibrated levels
+
+        # Noise-shaping filter, with the matrix products of the original loop (BLAS gemv/dot),
+        # as the rounding of the state decides quantiser ties
+        xn = Ad @ xns + Bd*e  # update state
+        xns[:] = xn
+        yns = np.dot(Cd, xns)  # update filter output
+
+    return C, satcnt, yns
+
+
+def nsdcal_batch(X, Dq, YQns, MLns, Qstep, Vmin, Nb, QMODEL, COMPILED=True, FILTER=(2, nsf.integrator)):
+    """
+    Batched nsdcal: R realisations stacked along a leading axis, e.g. independent channels,
+    Monte-Carlo draws of the level measurement errors, or headroom variants of the input.
+    Arguments with a single row are shared by all realisations. Each row gives the same
+    codes as nsdcal for that row.
+
+    Arguments
+        X - input signals, (R, N) or (N,) array
+        Dq - re-quantiser dither, (R, N) or (N,) array
+        YQns - ideal levels, (R, L) or (L,) array
+        MLns - measured levels, (R, L) or (L,) array
+        Qstep, Vmin, Nb, QMODEL - as for nsdcal
+        COMPILED - use the Numba-compiled loop (per realisation) if Numba is installed;
+            otherwise all noise-shaper states are advanced together per time step
+        FILTER - noise-shaping filter, (ORDER, DESIGN[, Wn]) for ns_filter
+
+    Returns
+        C - codes, (R, N) array
+    """
+    X, Dq, YQns, MLns = [np.atleast_2d(np.asarray(a, dtype=np.float64)) for a in [X, Dq, YQns, MLns]]
+    R = max(X.shape[0], Dq.shape[0], YQns.shape[0], MLns.shape[0])
+    X = np.broadcast_to(X, (R, X.shape[1]))
+    Dq = np.broadcast_to(Dq, (R, Dq.shape[1]))
+    YQns = np.broadcast_to(YQns, (R, YQns.shape[1]))
+    MLns = np.broadcast_to(MLns, (R, MLns.shape[1]))
+
+    Ad, Bd, Cd = ns_filter(*FILTER)  # precomputed balanced realisation
+    Bd, Cd = Bd.reshape(-1), Cd.reshape(-1)
+
+    if QMODEL == 3:
+        # Measured levels of each realisation sorted once (stable, ties to the lowest code)
+        Lo = np.argsort(MLns, axis=1, kind='stable')
+        Ls = np.take_along_axis(MLns, Lo, axis=1)
+    else:
+        Lo, Ls = np.zeros((R, 1), dtype=np.int64), np.zeros((R, 1))  # unused
+
+    if COMPILED and njit is not None:
+        C = np.zeros((R, X.shape[1]), dtype=np.int64)
+        satcnt = np.zeros(R, dtype=np.int64)
+        for r in range(0, R):
+            args = [np.ascontiguousarray(a[r]) for a in [X, Dq, YQns, MLns]]
+            C[r], satcnt[r], _ = nsdcal_kernel(*args, Ad, Bd, Cd, Qstep, Vmin, Nb, QMODEL,
+                                               np.ascontiguousarray(Ls[r]), np.ascontiguousarray(Lo[r]),
+                                               np.zeros(Ad.shape[0]), 0.0)
+    else:
+        C, satcnt = nsdcal_batch_loop(X, Dq, YQns, MLns, Ad, Bd, Cd, Qstep, Vmin, Nb, QMODEL, Ls, Lo)
+
+    for r in np.flatnonzero(satcnt >= 10):
+        print(f'warning: saturation in realisation {r} -- cnt: {satcnt[r]}')
+
+    return C
+
+
+def nsdcal_batch_loop(X, Dq, YQns, MLns, Ad, Bd, Cd, Qstep, Vmin, Nb, QMODEL, Ls, Lo):
+    """
+    Noise-shaping loop of nsdcal_loop, vectorised over the realisations (rows), so the
+    Python overhead of the re-quantiser is paid once per time step. The filter updates use
+    the same products as nsdcal_loop, so each row gives identical codes.
+    """
+    R, N = X.shape
+    n = Ad.shape[0]
+    L = Ls.shape[1]
+    rows = np.arange(R)
+
+    # Initialise states, outputs and errors
+    xns = np.zeros((R, n))  # noise-shaping filter states
+    yns = np.zeros(R)  # noise-shaping filter outputs
+
+    C = np.zeros((R, N), dtype=np.int64)  # save codes
+
+    satcnt = np.zeros(R, dtype=np.int64)  # saturation counters
+    c_max = 2**Nb - 1
+    c_off = math.floor(Vmin/Qstep)
+
+    if QMODEL == 3:
+        u_min = Ls[:, 0] - Qstep/2  # saturation limits
+        u_max = Ls[:, L-1] + Qstep/2
+        first = np.zeros((R, L), dtype=np.int64)  # first of equal levels, for ties
+        for r in range(0, R):
+            first[r] = np.searchsorted(Ls[r], Ls[r])
+        NBIS = L.bit_length()  # bisection steps
+
+    for i in range(0, N):
+        w = X[:, i] - yns  # use feedback
+        u = w + Dq[:, i]  # re-quantizer input
+
+        if QMODEL == 3:
+            # Re-quantizer (nearest measured level), bisection for all rows together
+            lo = np.zeros(R, dtype=np.int64)
+            hi = np.full(R, L, dtype=np.int64)
+            for _ in range(0, NBIS):
+                m = (lo + hi)//2
+                open_ = lo < hi
+                up = open_ & (Ls[rows, np.minimum(m, L-1)] < u)
+                hi = np.where(open_ & ~up, m, hi)
+                lo = np.where(up, m + 1, lo)
+            k = lo
+            km = np.maximum(k - 1, 0)
+            tie_lo = (k == L) | ((k > 0) & (u - Ls[rows, km] <= Ls[rows, np.minimum(k, L-1)] - u))
+            k = np.where(tie_lo, first[rows, km], k)
+            c = Lo[rows, k]  # codes
+            C[:, i] = c  # save codes
+
+            satcnt += (u > u_max) | (u < u_min)  # beyond the extreme levels
+        else:
+            # Re-quantizer (mid-tread)
+            c = np.floor(u/Qstep + 0.5).astype(np.int64) - c_off  # codes
+            C[:, i] = c  # save codes
+
+            # Saturation (can't index out of bounds)
+            satcnt += (c > c_max) | (c < 0)
+            c = np.clip(c, 0, c_max)
+
+        # Generate errors, model used in feedback
+        if QMODEL == 1:
+            e = YQns[rows, c] - w  # ideal levels
+        else:
+            e = MLns[rows, c] - w  # measured/calibrated levels
+
+        # Noise-shaping filters, one realisation at a time with the products of nsdcal_loop
+        # (a single matrix product for all rows rounds differently)
+        for r in range(0, R):
+            xns[r] = Ad @ xns[r] + Bd*e[r]  # update state
+            yns[r] = np.dot(Cd, xns[r])  # update filter output
+
+    return C, satcnt
+
+if njit is not None:
+    nsdcal_kernel = njit(cache=True)(nsdcal_loop)
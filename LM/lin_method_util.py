@@ -7,6 +7,10 @@
 @license: BSD 3-Clause
 """
 
+import numpy as np
+from scipy import linalg
+
+
 class lm:  # linearisation method
     BASELINE = 1  # baseline
     PHYSCAL = 2  # Physical level Calibration
@@ -63,6 +67,165 @@ class dm:  # DAC model
                 return '-'
 
 
+def prediction_matrices(A, B, C, D, N_PRED):
+    """
+    Lifted (condensed) prediction matrices of a state-space filter over a horizon.
+
+    The stacked filter outputs are E = Phi @ x0 + Gamma @ V, where x0 is the
+    initial state and V the stacked filter inputs, so a quadratic cost in E
+    is a dense quadratic in V without any state variables.
+
+    Arguments
+        A, B, C, D - state-space matrices of the (single-input, single-output) filter
+        N_PRED - prediction horizon
+    
+    Returns
+        Phi - state-to-output matrix (N_PRED x state dimension)
+        Gamma - input-to-output lower triangular Toeplitz matrix of Markov parameters (N_PRED x N_PRED)
+    """
+    x_dim = int(A.shape[0])
+
+    Phi = np.zeros((N_PRED, x_dim))
+    h = np.zeros(N_PRED)  # Markov parameters
+    h[0] = np.squeeze(D)
+
+    Ak = np.eye(x_dim)
+    for i in range(N_PRED):
+        Phi[i, :] = (C @ Ak).squeeze()
+        if i > 0:
+            h[i] = np.squeeze(C @ Ak_prev @ B)
+        Ak_prev = Ak
+        Ak = A @ Ak
+
+    Gamma = linalg.toeplitz(h, np.zeros(N_PRED))
+
+    return Phi, Gamma
+
+
+def horizon_cost(r, Gamma, V):
+    """
+    Bulk evaluation of the condensed horizon cost ||r + Gamma @ v||^2.
+
+    Arguments
+        r - free response over the horizon, Phi @ x0 - Gamma @ reference
+        Gamma - input-to-output matrix from prediction_matrices()
+        V - candidate level sequences, one per row (M x N_PRED)
+    
+    Returns
+        J - cost for each candidate (M)
+    """
+    E = r.reshape(1, -1) + V @ Gamma.T
+    return np.sum(E**2, 1)
+
+
+# Per-step record of an MHOQ run
+mhoq_stats_dtype = np.dtype([('build_time', 'f8'),  # model construction/update (seconds)
+                             ('solve_time', 'f8'),  # solver, excluding build time (seconds)
+                             ('step_time', 'f8'),  # whole step, including the loop overhead (seconds)
+                             ('nodes', 'i8'),  # nodes/candidates visited
+                             ('mip_gap', 'f8'),  # relative optimality gap (0 for exact search)
+                             ('sat', '?'),  # cost limited by saturation
+                             ('fallback', '?')])  # solver failed or hit its time limit, incumbent used
+
+
+def mhoq_stats(N):
+    """
+    Preallocated per-step record for N steps (see mhoq_stats_dtype).
+    """
+    S = np.zeros(N, dtype=mhoq_stats_dtype)
+    S['mip_gap'] = np.nan
+    return S
+
+
+def saturation_limited(r, Gamma, V, v_min, v_max):
+    """
+    True if the cost was limited by saturation, i.e. for some step the unconstrained
+    minimiser, given the levels V chosen for the previous steps, is outside [v_min, v_max].
+
+    Arguments
+        r - free response over the horizon
+        Gamma - input-to-output matrix from prediction_matrices()
+        V - chosen level sequence (N_PRED)
+        v_min, v_max - extreme levels
+    """
+    E = r + np.tril(Gamma, -1) @ V
+    T = -E/np.diag(Gamma)
+    return bool(np.any(T < v_min) or np.any(T > v_max))
+
+
+def mhoq_stats_summary(S):
+    """
+    Summary of a per-step record.
+
+    Returns
+        table - rows of (quantity, value)
+    """
+    gap = S['mip_gap'][~np.isnan(S['mip_gap'])]
+    table = [['Steps', f'{S.size}'],
+             ['Build time (total)', f'{np.sum(S["build_time"]):.3f} s'],
+             ['Solve time (total)', f'{np.sum(S["solve_time"]):.3f} s'],
+             ['Overhead (total)', f'{np.sum(S["step_time"] - S["build_time"] - S["solve_time"]):.3f} s'],
+             ['Solve time (median/P99/max)', f'{1e3*np.median(S["solve_time"]):.3f}/{1e3*np.percentile(S["solve_time"], 99):.3f}/{1e3*np.max(S["solve_time"]):.3f} ms'],
+             ['Nodes (mean/max)', f'{np.mean(S["nodes"]):.1f}/{np.max(S["nodes"])}'],
+             ['MIP gap (max)', f'{np.max(gap):.2e}' if gap.size else '-'],
+             ['Saturation limited', f'{np.sum(S["sat"])} ({100*np.mean(S["sat"]):.2f}%)'],
+             ['Solver fallbacks', f'{np.sum(S["fallback"])}' if 'fallback' in S.dtype.names else '-']]
+    return table
+
+
+# Per-iteration record of an ILC run
+ilc_stats_dtype = np.dtype([('rms_err', 'f8'),  # RMS of the ILC error (filtered output vs. reference)
+                            ('inband_err', 'f8'),  # power of the ILC error in the signal band
+                            ('changed', 'i8'),  # codes changed from the previous iteration
+                            ('enob', 'f8'),  # ENOB probe through the static DAC model (NaN if not probed)
+                            ('iter_time', 'f8')])  # whole iteration (seconds)
+
+
+def ilc_stats(N):
+    """
+    Preallocated per-iteration record for N iterations (see ilc_stats_dtype).
+    """
+    S = np.zeros(N, dtype=ilc_stats_dtype)
+    S['enob'] = np.nan
+    return S
+
+
+def inband_power(e, BAND=None):
+    """
+    Power of a signal in the band [0, BAND] (normalised frequency, 1 is Nyquist),
+    from the DFT over the whole signal (Parseval). The whole band if BAND is None.
+    """
+    e = np.asarray(e).reshape(-1)
+    if BAND is None:
+        return np.mean(e**2)
+
+    E = np.abs(np.fft.rfft(e))**2
+    w = np.full(E.size, 2.0)  # one-sided spectrum
+    w[0] = 1.0
+    if e.size % 2 == 0:
+        w[-1] = 1.0  # Nyquist bin
+    k = min(int(np.floor(BAND*e.size/2)), E.size - 1)
+    return np.sum(w[0:k+1]*E[0:k+1])/e.size**2
+
+
+def ilc_stats_summary(S):
+    """
+    Summary of a per-iteration record.
+
+    Returns
+        table - rows of (quantity, value)
+    """
+    enob = S['enob'][~np.isnan(S['enob'])]
+    k = np.argmin(S['rms_err'])
+    table = [['Iterations', f'{S.size}'],
+             ['Iteration time (total/mean)', f'{np.sum(S["iter_time"]):.3f}/{np.mean(S["iter_time"]):.3f} s'],
+             ['RMS error (first/last/best)', f'{S["rms_err"][0]:.3e}/{S["rms_err"][-1]:.3e}/{S["rms_err"][k]:.3e} (itr. {k+1})'],
+             ['In-band error power (first/last)', f'{S["inband_err"][0]:.3e}/{S["inband_err"][-1]:.3e}'],
+             ['Codes changed (last)', f'{S["changed"][-1]}'],
+             ['ENOB probe (last)', f'{enob[-1]:.3f}' if enob.size else '-']]
+    return table
+
+
 def main():
     """
     Test
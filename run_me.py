@@ -26,7 +26,7 @@ from matplotlib import pyplot as plt
 import datetime
 import pickle
 #from prefixed import Float
-#from tabulate import tabulate
+from tabulate import tabulate
 
 import utils.dither_generation as dither_generation
 from utils.dual_dither import dual_dither, hist_and_psd
@@ -36,11 +36,13 @@ from utils.static_dac_model import generate_dac_output, quantise_signal, generat
 from utils.figures_of_merit import FFT_SINAD, TS_SINAD
 from utils.balreal import balreal_ct, balreal
 from utils.mpc_filter_parameters import mpc_filter_parameters
+from utils.checkpoint import checkpoint
+from utils.generated_codes import codes_directory, save_codes
 
 from LM.lin_method_nsdcal import nsdcal
 from LM.lin_method_dem import dem
 # from lin_method_ilc import get_control, learning_matrices
-# from lin_method_ilc_simple import ilc_simple
+from LM.lin_method_ilc_simple import ilc_simple, ilc_simple_tune, gaussian_qfilter
 from LM.lin_method_mpc import MPC
 from LM.lin_method_mpc_bin import MPC_BIN
 # from lin_method_ILC_DSM import learningMatrices, get_ILC_control
@@ -90,6 +92,9 @@ Fc_lp = 100e3  # cut-off frequency in hertz
 N_lp = 3  # filter order
 
 N_PRED = 1 # prediction horizon (MPC)
+MHOQ_SOLVER = 'enum'  # 'gurobi'/'gurobi_persistent'/'gurobi_condensed' - MIQP, 'enum'/'sphere' - exact search (no licence needed), 'relaxed' - approximate
+MHOQ_N_PROC = 1  # > 1: solve MHOQ in segments on a process pool
+MHOQ_REFINE_K = 1  # 'relaxed' (approximate, e.g. for 16 bit) only: search +/- k levels around the rounded solution
 
 ##### METHOD CHOICE - Choose which linearisation method you want to test
 match METHOD_CHOICE:
@@ -184,6 +189,9 @@ Xref = (Xref_SCALE/100)*Xref  # scale reference (TODO: 100% here should be large
 # Each method should produce a vector of codes 'C'
 # that can be input to a given DAC circuit.
 
+STATS = None  # per-step record of the solver (MHOQ), or per-iteration record (ILC), saved with the codes
+STATS_F = 'mhoq_stats'
+
 match SC.lin.method:
     case lm.BASELINE:  # baseline, only carrier
         # Generate unmodified DAC output without any corrections.
@@ -263,9 +271,10 @@ match SC.lin.method:
 
         X = (Xscale/100)*Xref + Dq  # input
 
-        C = dem(X, Rng, Nb)  ##### output codes
+        DEM_NCH = 2  # number of DACs in the DEM tree (2, 4, 8); the level model needs as many channels
+        C = dem(X, Rng, Nb, DEM_NCH)  ##### output codes
 
-        Nch = 2  # number of physical channels  
+        Nch = DEM_NCH  # number of physical channels  
         # two identical, ideal channels
         # YQ = matlib.repmat(YQ, 2, 1)
 
@@ -327,7 +336,7 @@ match SC.lin.method:
         MLns_err = np.random.uniform(-ML_err_rng, ML_err_rng, MLns.shape)
         MLns = MLns + MLns_err
 
-        QMODEL = 2  # 1: no calibration, 2: use calibration
+        QMODEL = 2  # 1: no calibration, 2: use calibration, 3: calibration and re-quantise to nearest measured level
         C = nsdcal(X, Dq, YQns, MLns, Qstep, Vmin, Nb, QMODEL)  ##### output codes
 
         # Zero input to sec. channel for sims with two channels (only need one channel)
@@ -671,6 +680,15 @@ match SC.lin.method:
 
         SC.ref_scale = Xscale  # save param.
 
+        # Periodically save the progress to the codes directory, and resume if interrupted
+        # (serial MPC_BIN runs only, the other runs do not clear the checkpoint when done)
+        SC.nch = Nch
+        CKPT = None
+        if MHOQ_SOLVER != 'relaxed' and MHOQ_N_PROC <= 1:
+            codes_d, hash_stamp = codes_directory(SC)
+            CKPT = checkpoint(codes_d, 'mhoq')
+            CKPT.restore_rng()  # same "measurement/model error" when resuming
+
         # Ideal Levels
         YQns = YQ[0]
         
@@ -697,9 +715,19 @@ match SC.lin.method:
         # Quantiser model
         QMODEL = 2 #: 1 - no calibration, 2 - Calibration
 
-        # Run MPC Binary variables
-        MPC = MPC_BIN(Nb, Qstep, QMODEL, A1, B1, C1, D1)
-        C = MPC.get_codes(N_PRED, X, YQns, MLns_E)  ##### output codes
+        if MHOQ_SOLVER == 'relaxed':
+            # Relaxed and rounded, for level sets too large for the exact MHOQ (e.g. 16 bit)
+            MPC_R = MPC(Nb, Qstep, QMODEL, A1, B1, C1, D1)
+            C = MPC_R.get_codes(N_PRED, X, YQns, MLns_E, SOLVER=MHOQ_SOLVER, REFINE_K=MHOQ_REFINE_K)  ##### output codes
+            STATS = MPC_R.stats
+        else:
+            # Run MPC Binary variables
+            MPC = MPC_BIN(Nb, Qstep, QMODEL, A1, B1, C1, D1)
+            if MHOQ_N_PROC > 1:
+                C = MPC.get_codes_parallel(N_PRED, X, YQns, MLns_E, SOLVER=MHOQ_SOLVER, N_PROC=MHOQ_N_PROC)  ##### output codes
+            else:
+                C = MPC.get_codes(N_PRED, X, YQns, MLns_E, SOLVER=MHOQ_SOLVER, CHECKPOINT=CKPT)  ##### output codes
+            STATS = MPC.stats
 
         t = t[0:C.size]
 
@@ -711,11 +739,6 @@ match SC.lin.method:
 
         Nch = 1
 
-        # Quantisation dither
-        DITHER_ON = 1
-        Dq = dither_generation.gen_stochastic(t.size, Nch, Qstep, dither_generation.pdf.triangular_hp)
-        Dq = DITHER_ON*Dq[0]  # convert to 1d, add/remove dither
-
         # Headrooom for requantisation
         if QConfig == qs.w_16bit_SPICE: HEADROOM = 10  # 16 bit DAC
         elif QConfig == qs.w_6bit_ARTI: HEADROOM = 15  # 6 bit DAC
@@ -729,6 +752,17 @@ match SC.lin.method:
 
         SC.ref_scale = Xscale  # save param.
 
+        # Periodically save the progress to the codes directory, and resume if interrupted
+        SC.nch = Nch
+        codes_d, hash_stamp = codes_directory(SC)
+        CKPT = checkpoint(codes_d, 'dsm_ilc')
+        CKPT.restore_rng()  # same dither when resuming
+
+        # Quantisation dither
+        DITHER_ON = 1
+        Dq = dither_generation.gen_stochastic(t.size, Nch, Qstep, dither_generation.pdf.triangular_hp)
+        Dq = DITHER_ON*Dq[0]  # convert to 1d, add/remove dither
+
         # Ideal Levels
         YQns = YQ[0]
 
@@ -771,19 +805,39 @@ match SC.lin.method:
         # QMODEL = 1      # Ideal model
         QMODEL = 2      # Measured/Calibrated
 
-        # Tuning matrices
-        We = np.identity(len_X)
-        Wf = np.identity(len_X)*1e-4
-        Wdf = np.identity(len_X)*1e-1
-
         itr = 10
 
         dsmilc = DSM_ILC(Nb, Qstep, Vmin, Vmax, Qtype, QMODEL)
         # Get Q filtering, learning and output matrices
-        Q, L, G = dsmilc.learningMatrices(X.size, We, Wf, Wdf,fi)
+        match 2:
+            case 1:  # dense matrices, O(len_X^2) memory
+                # Tuning matrices
+                We = np.identity(len_X)
+                Wf = np.identity(len_X)*1e-4
+                Wdf = np.identity(len_X)*1e-1
+                Q, L, G = dsmilc.learningMatrices(X.size, We, Wf, Wdf,fi)
+            case 2:  # structured operators (FFT convolutions, CG solves), diagonal tuning weights
+                We, Wf, Wdf = 1.0, 1e-4, 1e-1
+                Q, L, G = dsmilc.learningOperators(X.size, We, Wf, Wdf, fi)
+            case 3:  # periodic (frequency-domain) ILC, reference periodic over the signal (coherent sampling)
+                We, Wf, Wdf = 1.0, 1e-4, 1e-1
+                Q, L, G, rho = dsmilc.periodicLearningOperators(X.size, We, Wf, Wdf, fi, Fs)
+
+        # Stop criteria and metrics (None/0 to run all iterations, without probing)
+        ILC_TOL = None  # relative change of the RMS ILC error (e.g. 1e-3)
+        ILC_DIVERGE = None  # RMS ILC error relative to the best iteration (e.g. 10.0)
+        ILC_PROBE_EVERY = 0  # ENOB probe through the static DAC model every k iterations
+
+        def enob_probe(C):
+            ym = generate_dac_output(C.astype(int), ML[0:1]).squeeze()
+            TRANSOFF = np.floor(1*Fs/Xref_FREQ).astype(int)
+            _, ENOB = process_sim_output(t[0:ym.size], ym, Fc_lp, Fs, N_lp, TRANSOFF, sinad_comp.CFIT)
+            return ENOB
 
         # Get DSM_ILC codes
-        C = dsmilc.get_codes(X, Dq, itr, YQns, MLns, Q, L, G)  ##### output codes
+        C = dsmilc.get_codes(X, Dq, itr, YQns, MLns, Q, L, G, CHECKPOINT=CKPT, TOL=ILC_TOL, DIVERGE=ILC_DIVERGE,
+                             BAND=Fc_lp/(Fs/2), ENOB_PROBE=enob_probe, PROBE_EVERY=ILC_PROBE_EVERY)  ##### output codes
+        STATS, STATS_F = dsmilc.stats, 'ilc_stats'
 
         # Zero input to sec. channel for sims with two channels (only need one channel)
         if QConfig == qs.w_6bit_2ch_SPICE or QConfig == qs.w_16bit_2ch_SPICE or QConfig == qs.w_10bit_2ch_SPICE:
@@ -811,18 +865,31 @@ match SC.lin.method:
         # Q filter
         M = 2001  # Support/filter length/no. of taps
         Q_Fc = 2.0e4  # Cut-off freq. (Hz)
-        alpha = (np.sqrt(2)*np.pi*Q_Fc*M)/(Fs*np.sqrt(np.log(4)))
-        sigma = (M - 1)/(2*alpha)
-        Qfilt = signal.windows.gaussian(M, sigma)
-        Qfilt = Qfilt/np.sum(Qfilt)
 
         # L filter tuning (for Fs = 1 MHz, Nb = 16 bit)
         kp = 0.3
         kd = 20
         Niter = 50
 
+        # Tune the gains and the Q-filter cut-off over a grid (candidates run together, see ilc_simple_tune)
+        ILC_TUNE = False
+        if ILC_TUNE:
+            ML = get_measured_levels(QConfig, SC.lin.method)
+
+            def enob_probe(C):
+                ym = generate_dac_output(C.clip(0, 2**Nb-1), ML[0:1]).squeeze()
+                TRANSOFF = np.floor(1*Fs/Xref_FREQ).astype(int)
+                _, ENOB = process_sim_output(t[0:ym.size], ym, Fc_lp, Fs, N_lp, TRANSOFF, sinad_comp.CFIT)
+                return ENOB
+
+            table, (kp, kd, Q_Fc) = ilc_simple_tune(x, G, Qstep, Nb, Qtype, Fs, [0.1, 0.3, 1.0], [0, 5, 20, 50],
+                                                    [1e4, 2e4, 5e4], M, Niter, ENOB_PROBE=enob_probe)
+            print(tabulate(table, headers='firstrow'))
+
+        Qfilt = gaussian_qfilter(M, Q_Fc, Fs)
+
         c, y1 = ilc_simple(x, G, Qfilt, Qstep, Nb, Qtype, kp, kd, Niter)  # TODO: Get this running again
-        c_ = c.clip(0, 2**16-1)
+        c_ = c.clip(0, 2**Nb-1)
         C = np.array([c_])
         print('** ILC simple end **')
 
@@ -832,15 +899,7 @@ match SC.lin.method:
 SC.nch = Nch  # update with no. channels set for simulation
 
 # Use the config to generate a hash; overwrite results for identical configurations 
-import hashlib
-hash_stamp = hashlib.sha1(SC.__str__().encode('utf-8')).hexdigest()
-
-top_d = 'generated_codes/'  # directory for generated codes and configuration info
-
-method_d = top_d + str(SC.lin).replace(" ", "_") + '/'  # archive outputs according to method
-os.makedirs(method_d, exist_ok=True)  # make sure the method directory exists
-
-codes_d = method_d + hash_stamp + '/'
+codes_d, hash_stamp = codes_directory(SC)  # generated_codes/<method>/<hash>/
 os.makedirs(codes_d, exist_ok=True)
 
 config_f = 'sim_config'  # file with configuration info
@@ -850,7 +909,10 @@ with open(os.path.join(codes_d, config_f + '.pickle'), 'wb') as fout:  # marshal
     pickle.dump(SC, fout)
 
 codes_f = codes_d + 'codes'
-np.save(codes_f, C)
+save_codes(codes_f, C, Nb)  # uint8/uint16
+
+if STATS is not None:
+    np.save(codes_d + STATS_F, STATS)
 
 if (DAC_MODEL_CHOICE == 1):
     run_static_model_and_post_processing(RUN_LM, hash_stamp, MAKE_PLOT=PLOTS)
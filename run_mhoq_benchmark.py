@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark the MHOQ solver backends on the same reconstruction filter and level set.
+
+Reports the throughput (samples/s), the distribution of the time per solve,
+the nodes visited per sample, the steps where the solver failed or hit its time
+limit (highs: highs_backend.TIME_LIMIT seconds per sample) and the incumbent was
+used, and the agreement of the codes with the
+reference backend. Backends whose solver is not installed are skipped, and
+backends whose solver raises an error (e.g. a size-limited licence) are listed
+as failed.
+Optionally, the approximate relaxed-and-rounded MHOQ (MPC, SOLVER='relaxed')
+is compared with an exact backend, including the ENOB loss on the static DAC model.
+
+@author: Arnfinn Eielsen, Bikash Adhikari
+@date: 18.10.2026
+@license: BSD 3-Clause
+"""
+
+import time
+import numpy as np
+from tabulate import tabulate
+
+from utils.quantiser_configurations import quantiser_configurations, get_measured_levels, qs
+from utils.mpc_filter_parameters import mpc_filter_parameters
+from utils.test_util import test_signal, sinad_comp
+from utils.static_dac_model import generate_dac_output
+from utils.spice_utils import process_sim_output
+from LM.lin_method_mpc import MPC
+from LM.lin_method_mpc_bin import MPC_BIN, seam_differences
+from LM.lin_method_util import lm
+
+
+def benchmark_backends(SOLVERS, N_PRED, X, YQns, MLns, Nb, Qstep, QMODEL, A1, B1, C1, D1):
+    """
+    Run every backend on the same problem.
+
+    Arguments
+        SOLVERS - backend names, the first available one is the reference for code agreement
+        N_PRED - prediction horizon
+        X - reference signal
+        YQns, MLns - ideal and measured levels
+        Nb, Qstep, QMODEL - quantiser params. and model
+        A1, B1, C1, D1 - reconstruction filter
+
+    Returns
+        table - one row per backend
+    """
+    headers = ['Backend', 'Samples/s', 'Median solve', 'P90 solve', 'P99 solve', 'Max solve', 'Nodes/sample', 'Fallbacks', 'Agreement']
+    table = [headers]
+    C_ref = None
+
+    for SOLVER in SOLVERS:
+        MPC = MPC_BIN(Nb, Qstep, QMODEL, A1, B1, C1, D1)
+        try:
+            t_start = time.perf_counter()
+            C = MPC.get_codes(N_PRED, X, YQns, MLns, SOLVER=SOLVER)
+            t_run = time.perf_counter() - t_start
+        except ImportError as err:  # solver not installed
+            print(f'{SOLVER}: skipped ({err})')
+            continue
+        except Exception as err:  # solver error, e.g. a size-limited licence
+            print(f'{SOLVER}: failed ({err})')
+            table.append([SOLVER, 'failed'] + ['-']*(len(headers) - 2))
+            continue
+
+        if C_ref is None:
+            C_ref = C
+        agreement = 100*np.mean(C == C_ref)
+
+        ts = MPC.stats['build_time'] + MPC.stats['solve_time']
+        table.append([SOLVER,
+                      f'{C.size/t_run:.1f}',
+                      f'{1e3*np.median(ts):.3f} ms',
+                      f'{1e3*np.percentile(ts, 90):.3f} ms',
+                      f'{1e3*np.percentile(ts, 99):.3f} ms',
+                      f'{1e3*np.max(ts):.3f} ms',
+                      f'{np.mean(MPC.stats["nodes"]):.1f}',
+                      f'{np.sum(MPC.stats["fallback"])}',
+                      f'{agreement:.2f}%'])
+
+    return table
+
+
+def benchmark_parallel(SOLVER, N_PRED, X, YQns, MLns, Nb, Qstep, QMODEL, A1, B1, C1, D1, N_PROC, WARMUP):
+    """
+    Compare a segment-parallel run with a serial run of the same backend.
+
+    Returns
+        table - run times, and the codes differing from the serial run after each seam
+    """
+    MPC = MPC_BIN(Nb, Qstep, QMODEL, A1, B1, C1, D1)
+
+    t_start = time.perf_counter()
+    C_ser = MPC.get_codes(N_PRED, X, YQns, MLns, SOLVER=SOLVER)
+    t_ser = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    C_par = MPC.get_codes_parallel(N_PRED, X, YQns, MLns, SOLVER=SOLVER, N_PROC=N_PROC, WARMUP=WARMUP)
+    t_par = time.perf_counter() - t_start
+
+    n_seam, n_diff = seam_differences(C_par, C_ser, MPC.seams, WINDOW=WARMUP)
+
+    table = [['Backend', 'Processes', 'Warm-up', 'Serial', 'Parallel', 'Diff. at seams', 'Diff. total'],
+             [SOLVER, N_PROC, WARMUP, f'{t_ser:.2f} s', f'{t_par:.2f} s', ' '.join(str(n) for n in n_seam), n_diff]]
+
+    return table
+
+
+def benchmark_relaxed(REFINE_KS, SOLVER, N_PRED, t, X, YQns, MLns, ML, Nb, Qstep, QMODEL, A1, B1, C1, D1, Fc, Nf, TRANSOFF):
+    """
+    Compare the relaxed-and-rounded MHOQ with an exact backend. The relaxed MHOQ
+    uses the model levels (measured levels with QMODEL 2) in the cost, so the exact
+    backend is run on the same problem, with the model levels in place of YQns.
+
+    Arguments
+        REFINE_KS - refinement neighbourhoods (+/- k levels) to run
+        SOLVER - exact backend (see MPC_BIN.get_codes)
+        t, X - time vector and reference signal (a few periods, for the ENOB)
+        ML - levels of the static DAC model used for the ENOB
+        Fc, Nf - output low-pass filter cut-off and order
+        TRANSOFF - samples removed at each end before computing the SINAD
+        (others as in benchmark_backends)
+
+    Returns
+        table - run time, code agreement, ENOB, and ENOB loss w.r.t. the exact backend
+    """
+    Fs = 1/(t[1] - t[0])
+
+    def enob(C):
+        ym = generate_dac_output(C.astype(int), ML).squeeze()
+        tm = t[0:ym.size]
+        _, ENOB = process_sim_output(tm, ym, Fc, Fs, Nf, TRANSOFF, sinad_comp.CFIT)
+        return ENOB
+
+    match QMODEL:
+        case 1:
+            QL = YQns
+        case 2:
+            QL = MLns
+
+    MPC_E = MPC_BIN(Nb, Qstep, QMODEL, A1, B1, C1, D1)
+    t_start = time.perf_counter()
+    C_ref = MPC_E.get_codes(N_PRED, X, QL, MLns, SOLVER=SOLVER)
+    t_run = time.perf_counter() - t_start
+    ENOB_ref = enob(C_ref)
+
+    table = [['Mode', 'Run time', 'Agreement', 'ENOB', 'ENOB loss'],
+             [SOLVER, f'{t_run:.2f} s', '100.00%', f'{ENOB_ref:.3f}', '-']]
+
+    for REFINE_K in REFINE_KS:
+        MPC_R = MPC(Nb, Qstep, QMODEL, A1, B1, C1, D1)
+        t_start = time.perf_counter()
+        C = MPC_R.get_codes(N_PRED, X, YQns, MLns, SOLVER='relaxed', REFINE_K=REFINE_K)
+        t_run = time.perf_counter() - t_start
+        ENOB = enob(C)
+
+        table.append([f'relaxed, k={REFINE_K}',
+                      f'{t_run:.2f} s',
+                      f'{100*np.mean(C == C_ref):.2f}%',
+                      f'{ENOB:.3f}',
+                      f'{ENOB_ref - ENOB:.3f}'])
+
+    return table
+
+
+def main():
+    """
+    Benchmark configuration.
+    """
+    QConfig = qs.w_6bit_ARTI
+    FS_CHOICE = 4  # reconstruction filter (see mpc_filter_parameters)
+    Fs = 1022976  # sampling rate matching the filter
+    N_PRED = 1  # prediction horizon
+    Ns = 2000  # number of samples
+    QMODEL = 2  # 1 - no calibration, 2 - calibration
+
+    SOLVERS = ['enum', 'sphere', 'gurobi', 'gurobi_persistent', 'gurobi_condensed', 'highs', 'cpsat']
+
+    PARALLEL = False  # also compare a segment-parallel run with a serial run
+    N_PROC = 4  # processes for the parallel run
+    WARMUP = 200  # warm-up overlap per segment
+
+    RELAXED = False  # also compare the relaxed-and-rounded MHOQ with the first backend
+    REFINE_KS = [0, 1, 2]  # refinement neighbourhoods for the relaxed MHOQ
+    Fx = 1000  # reference frequency
+    Fc = 100e3  # output low-pass filter cut-off
+    Nf = 3  # output low-pass filter order
+
+    Nb, Mq, Vmin, Vmax, Rng, Qstep, YQ, Qtype = quantiser_configurations(QConfig)
+
+    # Reference signal
+    t = np.arange(0, Ns)/Fs
+    X = test_signal(100, Rng/2 - Qstep, 1000, -Qstep/2, t)
+
+    # Levels, with some "measurement/model error"
+    YQns = YQ[0]
+    ML = get_measured_levels(QConfig, lm.MPC)
+    MLns = ML[0]
+    np.random.seed(1)
+    MLns = MLns + np.random.uniform(-Qstep/1024, Qstep/1024, MLns.shape)
+
+    # Reconstruction filter
+    A1, B1, C1, D1 = mpc_filter_parameters(FS_CHOICE)
+
+    table = benchmark_backends(SOLVERS, N_PRED, X, YQns, MLns, Nb, Qstep, QMODEL, A1, B1, C1, D1)
+
+    print(f'QConfig: {QConfig}, Nb: {Nb}, N_PRED: {N_PRED}, samples: {Ns}')
+    print(tabulate(table, headers='firstrow'))
+
+    if PARALLEL:
+        table = benchmark_parallel(SOLVERS[0], N_PRED, X, YQns, MLns, Nb, Qstep, QMODEL, A1, B1, C1, D1, N_PROC, WARMUP)
+        print(tabulate(table, headers='firstrow'))
+
+    if RELAXED:
+        # A few periods of the reference, for the ENOB
+        t = np.arange(0, int(5*Fs/Fx))/Fs
+        X = test_signal(100, Rng/2 - Qstep, Fx, -Qstep/2, t)
+        TRANSOFF = np.floor(1*Fs/Fx).astype(int)
+
+        table = benchmark_relaxed(REFINE_KS, SOLVERS[0], N_PRED, t, X, YQns, MLns, ML, Nb, Qstep, QMODEL, A1, B1, C1, D1, Fc, Nf, TRANSOFF)
+        print(tabulate(table, headers='firstrow'))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@ from utils.quantiser_configurations import quantiser_configurations, qs
 from LM.lin_method_util import lm, dm
 from utils.spice_utils import run_spice_sim, run_spice_sim_parallel, gen_spice_sim_file, read_spice_bin_file, process_sim_output
 from utils.inl_processing import get_physcal_gain
+from utils.generated_codes import load_codes
 
 # choose method
 METHOD_CHOICE = 6
@@ -92,7 +93,7 @@ else:
 codes_fn = 'codes.npy'  # TODO: magic constant, name of codes file
 
 if os.path.exists(os.path.join(method_d, codes_d, codes_fn)):  # codes exists
-    C = np.load(os.path.join(method_d, codes_d, codes_fn))
+    C = load_codes(os.path.join(method_d, codes_d, codes_fn))  # memory-mapped
 else:
     raise SystemExit('No codes file found.')
 
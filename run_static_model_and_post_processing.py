@@ -18,12 +18,13 @@ from prefixed import Float
 from tabulate import tabulate
 
 from utils.results import handle_results
-from utils.static_dac_model import generate_dac_output, quantise_signal, generate_codes, quantiser_type
+from utils.static_dac_model import generate_dac_output, generate_summed_dac_output, quantise_signal, generate_codes, quantiser_type
 from utils.quantiser_configurations import quantiser_configurations, get_measured_levels, qs
 from utils.spice_utils import run_spice_sim, run_spice_sim_parallel, gen_spice_sim_file, read_spice_bin_file, process_sim_output
 from LM.lin_method_util import lm, dm
 from utils.test_util import sim_config, sinad_comp, test_signal
 from utils.inl_processing import get_physcal_gain
+from utils.generated_codes import load_codes
 
 
 def run_static_model_and_post_processing(RUN_LM, hash_stamp, MAKE_PLOT=False):
@@ -60,7 +61,7 @@ def run_static_model_and_post_processing(RUN_LM, hash_stamp, MAKE_PLOT=False):
     codes_fn = 'codes.npy'  # TODO: magic constant, name of codes file
 
     if os.path.exists(os.path.join(method_d, codes_d, codes_fn)):  # codes exists
-        C = np.load(os.path.join(method_d, codes_d, codes_fn))
+        C = load_codes(os.path.join(method_d, codes_d, codes_fn))  # memory-mapped
     else:
         raise SystemExit('No codes file found.')
 
@@ -69,9 +70,7 @@ def run_static_model_and_post_processing(RUN_LM, hash_stamp, MAKE_PLOT=False):
 
     # use static non-linear quantiser model to simulate DAC
 
-    ML = get_measured_levels(QConfig, SC.lin.method)
-    YM = generate_dac_output(C.astype(int), ML)  # using measured or randomised levels
-    tm = t[0:YM.size]
+    ML = get_measured_levels(QConfig, SC.lin.method)  # using measured or randomised levels
 
     # Summation stage
     if SC.lin.method == lm.BASELINE:
@@ -95,7 +94,7 @@ def run_static_model_and_post_processing(RUN_LM, hash_stamp, MAKE_PLOT=False):
     print('Summing gain:')
     print(K)
 
-    ym = np.sum(K*YM, 0)
+    ym = generate_summed_dac_output(C, ML, K)  # DAC model and summation in one pass
     t = t[0:len(ym)]
 
     TRANSOFF = np.floor(1*Fs/Fx).astype(int)  # remove transient effects from output
@@ -113,4 +112,9 @@ def run_static_model_and_post_processing(RUN_LM, hash_stamp, MAKE_PLOT=False):
     # [str(SC.qconfig), str(SC.lin), str(SC.dac), f'{Float(SC.fs):.2h}', f'{Float(SC.fc):.1h}', f'{Float(SC.ref_scale):.1h}%', f'{Float(SC.ref_freq):.1h}', f'{Float(ENOB_M):.3h}']]
     # print(tabulate(results_tab))
 
-    handle_results(SC, ENOB_M)
+    STATS = None
+    for stats_fn in ['mhoq_stats.npy', 'ilc_stats.npy']:  # per-step solver record (MHOQ), per-iteration record (ILC)
+        if os.path.exists(os.path.join(method_d, codes_d, stats_fn)):
+            STATS = np.load(os.path.join(method_d, codes_d, stats_fn))
+
+    handle_results(SC, ENOB_M, STATS)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Checkpoint and resume long code generation runs (MHOQ, DSM-ILC).
+
+Progress is written to the codes directory of the run, i.e.
+generated_codes/<method>/<hash>/ (see generated_codes.codes_directory),
+and removed when the run completes.
+
+@author: Arnfinn Eielsen, Bikash Adhikari
+@date: 18.10.2026
+@license: BSD 3-Clause
+"""
+
+import os
+import time
+import random
+import pickle
+import hashlib
+import numpy as np
+
+
+def fingerprint(*args):
+    """
+    Hash of the inputs of a run; a checkpoint is only resumed for identical inputs.
+    """
+    h = hashlib.sha1()
+    for a in args:
+        if hasattr(a, 'fingerprint'):  # e.g. matrix-free operators
+            h.update(a.fingerprint.encode('utf-8'))
+            continue
+        a = np.asarray(a)
+        h.update(str(a.dtype).encode('utf-8') + str(a.shape).encode('utf-8'))
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+class checkpoint:
+    """
+    Periodically persisted progress of a run.
+    :param codes_d: Codes directory of the run (see generated_codes.codes_directory)
+    :param name: Name of the checkpoint, e.g. the method
+    :param INTERVAL: Minimum time between saves (seconds)
+    """
+    def __init__(self, codes_d, name, INTERVAL=60):
+        self.codes_d = codes_d
+        self.path = os.path.join(codes_d, name + '_checkpoint.pickle')
+        self.rng_path = os.path.join(codes_d, name + '_rng_start.pickle')
+        self.INTERVAL = INTERVAL
+        self.t_last = time.monotonic()
+
+    def restore_rng(self):
+        """
+        Call before generating random inputs (dither, level errors). If an interrupted
+        run is being resumed, the RNG state from its start is restored, so that the
+        inputs are regenerated identically; otherwise the current state is recorded.
+        """
+        if os.path.exists(self.rng_path):
+            with open(self.rng_path, 'rb') as fin:
+                np_state, py_state = pickle.load(fin)
+            np.random.set_state(np_state)
+            random.setstate(py_state)
+        else:
+            self.dump(self.rng_path, (np.random.get_state(), random.getstate()))
+
+    def due(self):
+        """
+        True if INTERVAL has passed since the last save.
+        """
+        return time.monotonic() - self.t_last >= self.INTERVAL
+
+    def save(self, fp, **state):
+        """
+        Persist the progress (codes so far, filter state, loop indices, ...) and the RNG state.
+        :param fp: Fingerprint of the inputs (see fingerprint)
+        """
+        state['fingerprint'] = fp
+        state['rng'] = (np.random.get_state(), random.getstate())
+        self.dump(self.path, state)
+        self.t_last = time.monotonic()
+
+    def load(self, fp):
+        """
+        Load the progress of an interrupted run and restore the RNG state.
+        :param fp: Fingerprint of the inputs (see fingerprint)
+        :return: The saved state, or None if there is nothing (matching) to resume
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, 'rb') as fin:
+            state = pickle.load(fin)
+
+        if state['fingerprint'] != fp:
+            print('Checkpoint inputs differ from this run; starting from the beginning.')
+            return None
+
+        np_state, py_state = state['rng']
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+
+        return state
+
+    def clear(self):
+        """
+        Remove the checkpoint when the run has completed.
+        """
+        for path in [self.path, self.rng_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def dump(self, path, obj):
+        # Write to a temporary file first, so an interruption never leaves a partial checkpoint
+        os.makedirs(self.codes_d, exist_ok=True)
+        with open(path + '.tmp', 'wb') as fout:
+            pickle.dump(obj, fout)
+        os.replace(path + '.tmp', path)
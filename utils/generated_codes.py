@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Storage of the generated codes.
+
+The codes of a run are saved in its codes directory, generated_codes/<method>/<hash>/,
+in the smallest unsigned type for the DAC (see save_codes), and memory-mapped when
+loaded (see load_codes).
+
+@author: Arnfinn Eielsen, Bikash Adhikari
+@date: 18.10.2026
+@license: BSD 3-Clause
+"""
+
+import hashlib
+import numpy as np
+
+
+def codes_directory(SC, top_d='generated_codes/'):
+    """
+    Directory for the generated codes and configuration info of a run.
+
+    Arguments
+        SC - simulation configuration (sim_config)
+        top_d - top directory for generated codes
+
+    Returns
+        codes_d - generated_codes/<method>/<hash>/
+        hash_stamp - hash of the configuration
+    """
+    # Use the config to generate a hash; overwrite results for identical configurations
+    hash_stamp = hashlib.sha1(SC.__str__().encode('utf-8')).hexdigest()
+
+    method_d = top_d + str(SC.lin).replace(" ", "_") + '/'  # archive outputs according to method
+    codes_d = method_d + hash_stamp + '/'
+
+    return codes_d, hash_stamp
+
+
+def codes_dtype(Nb):
+    """
+    Smallest unsigned integer type for the codes of an Nb-bit DAC.
+    """
+    if Nb <= 8:
+        return np.uint8
+    elif Nb <= 16:
+        return np.uint16
+    else:
+        return np.uint32
+
+
+def save_codes(codes_f, C, Nb):
+    """
+    Save codes in the smallest unsigned integer type for the DAC (uint8 for up to 8 bits,
+    uint16 up to 16 bits), as .npy; the header records the type and the shape.
+
+    Arguments
+        codes_f - file name (.npy is appended if missing)
+        C - codes, one channel per row
+        Nb - number of bits of the DAC
+    """
+    C = np.asarray(C)
+    if C.size and (np.min(C) < 0 or np.max(C) > 2**Nb - 1 or np.any(C != np.round(C))):
+        raise ValueError(f'Codes must be integers in 0..{2**Nb - 1} for a {Nb} bit DAC.')
+    np.save(codes_f, C.astype(codes_dtype(Nb)))
+
+
+def load_codes(codes_f, mmap_mode='r'):
+    """
+    Load codes (see save_codes), memory-mapped by default so that only the channels and
+    sample windows used are read from disk. Code files from earlier runs (int64) also load.
+
+    Arguments
+        codes_f - file name
+        mmap_mode - memory-map mode for np.load, None to read the whole file
+
+    Returns
+        C - codes, one channel per row (read-only memory map with mmap_mode 'r')
+    """
+    return np.load(codes_f, mmap_mode=mmap_mode)
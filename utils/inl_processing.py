@@ -18,7 +18,7 @@ from matplotlib import pyplot as plt
 import sys
 sys.path.append('../')
 
-from utils.quantiser_configurations import quantiser_configurations, get_measured_levels, qs
+from utils.quantiser_configurations import quantiser_configurations, get_measured_levels, qs, level_index
 
 def generate_random_output_levels(QConfig=4):
     """
@@ -216,9 +216,13 @@ def generate_physcal_lut(QConfig=qs.w_16bit_NI_card, UNIFORM_SEC=1, SAVE_LUT=0):
     Nl = Mq + 1  # number of output levels
     LUTcal = np.zeros(Nl)  # initialise look-up table (LUT)
     err = ML - YQ  # compute level errors (same as INL*Qstep)
-    for k in range(0,Nl):
-        errc = abs(err[k] + CL)  # given all secondary outputs, compute the errors for a given primary code
-        LUTcal[k] = np.argmin(errc)  # save the secondary code that yields the smallest error
+    match 2:
+        case 1:  # linear scan over the secondary outputs
+            for k in range(0,Nl):
+                errc = abs(err[k] + CL)  # given all secondary outputs, compute the errors for a given primary code
+                LUTcal[k] = np.argmin(errc)  # save the secondary code that yields the smallest error
+        case 2:  # bisection in the sorted secondary outputs
+            LUTcal = level_index(CL).nearest(-err.squeeze())  # secondary code with the output nearest -err
 
     LUTcal = LUTcal.astype(np.uint16)  # convert to integers
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Noise-shaping loop filters (NSDCAL, DSM-ILC), as balanced state-space realisations.
+
+Realisations are keyed by order and design parameters, checked for stability, and
+computed only once; they are kept in memory and cached to disk in generated_ns_filters/.
+
+@author: Arnfinn Aas Eielsen
+@date: 18.10.2026
+@license: BSD 3-Clause
+"""
+
+import os
+import numpy as np
+from pathlib import Path
+from scipy import signal
+from utils.balreal import balreal
+
+
+class nsf:  # noise-shaping filter design
+    integrator = 1  # Hns = (1 - z^-1)^n, FIR (n = 2 is the double integrator)
+    butter = 2  # Hns = (1 - z^-1)^n/A(z), A(z) from a Butterworth high-pass design with cut-off Wn
+    iir3 = 3  # 3rd order IIR, tabulated coefficients
+
+
+_ns_filters = {}  # realisations computed in this session
+
+
+def ns_filter(ORDER=2, DESIGN=nsf.integrator, Wn=0.25, CACHE_D=None):
+    """
+    Noise-shaping loop filter Mns = 1 - Hns as a balanced realisation.
+
+    Arguments
+        ORDER - filter order
+        DESIGN - filter design (see nsf)
+        Wn - normalised cut-off frequency (1 is Nyquist) for nsf.butter
+        CACHE_D - directory of the disk cache (default generated_ns_filters/)
+
+    Returns
+        Ad, Bd, Cd - balanced realisation (read-only arrays), Mns is strictly proper
+    """
+    if DESIGN != nsf.butter:
+        Wn = 0.0  # not a design parameter
+    key = (int(ORDER), int(DESIGN), float(Wn))
+
+    if key in _ns_filters:
+        return _ns_filters[key]
+
+    if CACHE_D is None:
+        CACHE_D = Path(__file__).parent / '../generated_ns_filters'  # absolute path
+    cache_file = os.path.join(CACHE_D, 'ns_filter_{}_{}_{}.npz'.format(*key))
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as F:
+            Ad, Bd, Cd = F['Ad'], F['Bd'], F['Cd']
+    else:
+        AM, BM, CM = ns_filter_design(*key)
+
+        # Make a balanced realisation.
+        # Less sensitivity to filter coefficients in the IIR implementation.
+        # (Useful if having to used fixed-point implementation and/or if the filter order is to be high.)
+        Ad, Bd, Cd, Dd = balreal(AM, BM, CM, np.zeros((1, 1)))
+
+        os.makedirs(CACHE_D, exist_ok=True)
+        np.savez(cache_file, Ad=Ad, Bd=Bd, Cd=Cd)
+
+    Ad, Bd, Cd = [np.ascontiguousarray(M, dtype=np.float64) for M in [Ad, Bd, Cd]]
+    for M in [Ad, Bd, Cd]:
+        M.setflags(write=False)  # shared between callers
+
+    _ns_filters[key] = (Ad, Bd, Cd)
+
+    return Ad, Bd, Cd
+
+
+def ns_filter_design(ORDER, DESIGN, Wn):
+    """
+    State-space realisation (AM, BM, CM) of Mns = 1 - Hns for a given design.
+    """
+    match DESIGN:
+        case nsf.integrator:
+            # Mns = sum_k m_k z^-k as a shift register; n = 2 gives the original double integrator realisation
+            m = -np.poly(np.ones(ORDER))[1:]  # Hns = (1 - z^-1)^n
+            AM = np.eye(ORDER, k=-1)
+            BM = np.zeros((ORDER, 1))
+            BM[0, 0] = m[0]
+            CM = (m/m[0]).reshape(1, -1)
+        case nsf.butter:
+            b, a = signal.butter(ORDER, Wn, 'high')
+            bh = np.poly(np.ones(ORDER))  # Hns = (1 - z^-1)^n/A(z), monic
+            AM, BM, CM, DM = signal.tf2ss((a - bh)[1:], a)  # Mns = (A(z) - (1 - z^-1)^n)/A(z)
+        case nsf.iir3:
+            if ORDER != 3:
+                raise ValueError('The nsf.iir3 design is 3rd order.')
+            AM = np.array([[0.3538, -0.3666, 0.0330], [1.0000,  0,  0], [ 0, 1.0000 , 0]])
+            BM = np.array([ [1], [0],[0]])
+            CM = np.array([[-1.4063,    0.8164 ,  -0.2451]])
+        case _:
+            raise ValueError('Unknown noise-shaping filter design.')
+
+    # Stability check (the loop filter must be stable to be balanced, and for the noise-shaping loop)
+    if ORDER > 0 and np.max(np.abs(np.linalg.eigvals(AM))) >= 1:
+        raise ValueError('Noise-shaping filter is not stable.')
+
+    return AM, BM, CM
@@ -153,6 +153,77 @@ def quantiser_configurations(QConfig):
     return Nb, Mq, Vmin, Vmax, Rng, Qstep, YQ, Qtype
 
 
+class level_index:
+    """
+    Output levels sorted once, for nearest-level and range queries by bisection, i.e.
+    O(log L) per query instead of a linear scan over all L levels. Measured levels need
+    not be monotonic in the code, so the code permutation is kept; queries return codes.
+    Equal levels are kept in code order (stable sort), so ties resolve to the lowest code.
+
+    Arguments
+        levels - output levels, one per code, 1d array
+    """
+    def __init__(self, levels):
+        self.levels = np.asarray(levels).reshape(-1)
+        self.order = np.argsort(self.levels, kind='stable')  # sorted position -> code
+        self.sorted = self.levels[self.order]  # levels in ascending order
+        self.rank = np.empty_like(self.order)  # code -> sorted position
+        self.rank[self.order] = np.arange(self.order.size)
+        self.size = self.sorted.size
+
+    def nearest_sorted(self, y):
+        """
+        Sorted position of the level nearest y (scalar or array); ties go to the lower level.
+        """
+        L = self.size
+        if np.ndim(y) == 0:  # fast path for per-sample loops
+            k = int(np.searchsorted(self.sorted, y))
+            if k == L or (k > 0 and y - self.sorted[k-1] <= self.sorted[k] - y):
+                k = int(np.searchsorted(self.sorted, self.sorted[k-1]))  # first of equal levels
+            return k
+
+        y = np.asarray(y)
+        k = np.searchsorted(self.sorted, y)
+        lo = np.maximum(k - 1, 0)
+        hi = np.minimum(k, L - 1)
+        lo = np.searchsorted(self.sorted, self.sorted[lo])  # first of equal levels
+        return np.where((k == L) | ((k > 0) & (y - self.sorted[lo] <= self.sorted[hi] - y)), lo, hi)
+
+    def nearest(self, y):
+        """
+        Code of the level nearest y (scalar or array).
+        """
+        return self.order[self.nearest_sorted(y)]
+
+    def nearest_k(self, y, k):
+        """
+        Codes of the k levels nearest y, ordered by distance (array with a trailing axis of length k).
+        The k nearest are contiguous in sorted order, so only 2k candidates around the bisection point are checked.
+        """
+        y = np.asarray(y, dtype=float)
+        L = self.size
+        k = min(k, L)
+        w = min(2*k, L)  # candidate window
+
+        p = np.searchsorted(self.sorted, y)
+        start = np.clip(p - k, 0, L - w)
+        P = start[..., np.newaxis] + np.arange(w)
+
+        d = np.abs(self.sorted[P] - y[..., np.newaxis])
+        sel = np.argsort(d, axis=-1, kind='stable')[..., 0:k]
+
+        return self.order[np.take_along_axis(P, sel, -1)]
+
+    def within(self, y, radius):
+        """
+        Levels within radius of y (scalar or array), as sorted position bounds (lo, hi),
+        i.e. the codes are order[lo:hi].
+        """
+        lo = np.searchsorted(self.sorted, np.asarray(y) - radius, 'left')
+        hi = np.searchsorted(self.sorted, np.asarray(y) + radius, 'right')
+        return lo, hi
+
+
 def get_ML(inpath, infile, CSV_filename):
     CSV_file = os.path.join(inpath, CSV_filename)
 
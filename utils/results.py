@@ -1,4 +1,4 @@
-from LM.lin_method_util import lm, dm
+from LM.lin_method_util import lm, dm, mhoq_stats_summary, ilc_stats_dtype, ilc_stats_summary
 
 from tabulate import tabulate
 from prefixed import Float
@@ -7,7 +7,12 @@ import json
 import os
 
 
-def handle_results(SC, ENOB):
+def handle_results(SC, ENOB, STATS=None):
+    """
+    Store and print the results of a run.
+    STATS - optional per-step solver record (MHOQ, see lin_method_util.mhoq_stats) or per-iteration
+            record (ILC, see lin_method_util.ilc_stats), summarised with the results
+    """
     JR = JSON_results()
 
     JR.add( DC=SC.qconfig,       # DAC configuration
@@ -25,6 +30,12 @@ def handle_results(SC, ENOB):
     JR.save()
     JR.save_to_html()
 
+    if STATS is not None:
+        if STATS.dtype == ilc_stats_dtype:
+            print(tabulate([['ILC statistics', '']] + ilc_stats_summary(STATS), headers='firstrow'))
+        else:
+            print(tabulate([['Solver statistics', '']] + mhoq_stats_summary(STATS), headers='firstrow'))
+
 
 class JSON_results():
     def __init__(self, **kwargs) -> None:
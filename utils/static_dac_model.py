@@ -14,17 +14,25 @@ class quantiser_type:
     midriser = 2
 
 
-def quantise_signal(w, Qstep, Qtype):
+def quantise_signal(w, Qstep, Qtype, out=None):
     """
     Quantise a signal with given quantiser specifications
+    out - optional array for the result (may be w), to reuse buffers
     """
-    
+    if out is None:
+        out = np.empty(np.shape(w))
+
     match Qtype:
         case quantiser_type.midtread:
-            q = np.floor(w/Qstep + 0.5) # truncated/quantised value, mid-tread
+            np.divide(w, Qstep, out=out)
+            out += 0.5
+            np.floor(out, out=out) # truncated/quantised value, mid-tread
         case quantiser_type.midriser:
-            q = np.floor(w/Qstep) + 0.5 # truncated/quantised value, mid-riser
+            np.divide(w, Qstep, out=out)
+            np.floor(out, out=out)
+            out += 0.5 # truncated/quantised value, mid-riser
     
+    q = out
     return q
 
 
@@ -80,3 +88,56 @@ def generate_dac_output(C, ML):
                 Y[k,:] = ML[k,C[k,:]]
         
     return Y
+
+
+def generate_summed_dac_output(C, ML, K=1.0, out=None, dtype=np.float64, BLOCK=2**16):
+    """
+    Static non-linear DAC model with a summation stage, in one pass: the summed output
+    sum_k K[k]*ML[k, C[k, :]], without the full-size per-channel output (generate_dac_output)
+    and the weighted temporary
+
+    Parameters
+    ----------
+    C
+        input codes, one channel per row, integers (any integer type), 2d array
+    ML
+        static DAC model output levels, one channel per row, 2d array
+    K
+        summing gains, scalar or one per channel
+    out
+        optional output buffer (1d, C.shape[1] samples)
+    dtype
+        output type, e.g. np.float32 to halve the memory
+    BLOCK
+        samples per block (bounds the temporary)
+
+    Returns
+    -------
+    y
+        emulated, summed DAC output
+    """
+
+    if C.shape[0] > ML.shape[0]:
+        raise ValueError('Not enough channels in model.')
+
+    Nch, N = C.shape
+    K = np.broadcast_to(np.asarray(K, dtype=np.float64).reshape(-1), (Nch,))
+
+    # Scale the (small) level tables instead of the output
+    MLK = [(K[k]*ML[k]).astype(dtype) for k in range(0, Nch)]
+
+    if out is None:
+        out = np.empty(N, dtype=dtype)
+    elif out.shape != (N,):
+        raise ValueError('Output buffer does not match the number of samples.')
+
+    tmp = np.empty(min(BLOCK, N), dtype=out.dtype)
+    for j in range(0, N, BLOCK):
+        y = out[j:j+BLOCK]
+        np.take(MLK[0], C[0, j:j+BLOCK], out=y)
+        for k in range(1, Nch):
+            z = tmp[0:y.size]
+            np.take(MLK[k], C[k, j:j+BLOCK], out=z)
+            y += z
+
+    return out